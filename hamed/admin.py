@@ -6,6 +6,9 @@ from django.contrib import admin
 from hamed.models.collects import Collect
 from hamed.models.targets import Target
 from hamed.models.settings import Settings
+from hamed.models.jobs import Job
+from hamed.models.task_runs import TaskRun
+from hamed.models.task_checkpoints import TaskCheckpoint
 
 
 class HamedAdminSite(admin.AdminSite):
@@ -50,3 +53,40 @@ class TargetAdmin(admin.ModelAdmin):
         "collect",
     )
     list_filter = ("collect", "gender", "is_indigent")
+
+
+@admin.register(Job, site=admin_site)
+class JobAdmin(admin.ModelAdmin):
+    list_display = (
+        "id",
+        "kind",
+        "collect",
+        "status",
+        "progress",
+        "step",
+        "worker",
+        "created_on",
+        "ended_on",
+    )
+    list_filter = ("kind", "status")
+
+
+@admin.register(TaskRun, site=admin_site)
+class TaskRunAdmin(admin.ModelAdmin):
+    list_display = (
+        "job",
+        "collection",
+        "task",
+        "status",
+        "wall_time",
+        "cpu_time",
+        "peak_memory",
+        "counts",
+    )
+    list_filter = ("collection", "task", "status")
+
+
+@admin.register(TaskCheckpoint, site=admin_site)
+class TaskCheckpointAdmin(admin.ModelAdmin):
+    list_display = ("collect", "collection", "completed", "updated_on")
+    exclude = ("outputs",)
@@ -0,0 +1,7 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim: ai ts=4 sts=4 et sw=4 nu
+
+# folders of a collect's documents tree
+PERSONAL_FILES = "Dossiers"
+PRINTS = "Impressions"
@@ -74,3 +74,29 @@ class MultipleUSBDisksPlugged(Exception):
 
 class NoUSBDiskPlugged(Exception):
     pass
+
+
+class BatchError(Exception):
+    """failure of some items of a batch: errors is [(item, message)]"""
+
+    title = "Unable to process {nb} item(s)"
+
+    def __init__(self, errors, *args, **kwargs):
+        super(BatchError, self).__init__(*args, **kwargs)
+        self.errors = errors
+
+    def __str__(self):
+        return "{title}: {errors}".format(
+            title=self.title.format(nb=len(self.errors)),
+            errors=", ".join(
+                ["{item} ({exp})".format(item=i, exp=e) for i, e in self.errors]
+            ),
+        )
+
+
+class DocumentsGenerationError(BatchError):
+    title = "Unable to generate documents for {nb} target(s)"
+
+
+class MediasExportError(BatchError):
+    title = "Unable to export {nb} media(s)"
@@ -2,8 +2,15 @@
 # -*- coding: utf-8 -*-
 # vim: ai ts=4 sts=4 et sw=4 nu
 
-import logging
 import io
+import os
+import re
+import logging
+import zipfile
+import posixpath
+import threading
+import xml.etree.ElementTree as ET
+from xml.sax.saxutils import escape
 
 from openpyxl import load_workbook
 from openpyxl.utils.exceptions import InvalidFileException
@@ -16,8 +23,177 @@ from hamed.exports.xlsx import (
 
 logger = logging.getLogger(__name__)
 
+NS = {
+    "main": "http://schemas.openxmlformats.org/spreadsheetml/2006/main",
+    "r": "http://schemas.openxmlformats.org/officeDocument/2006/relationships",
+    "rels": "http://schemas.openxmlformats.org/package/2006/relationships",
+}
+_templates = {}
+_templates_lock = threading.Lock()
+
+
+class XLSFormTemplate(object):
+    """XLSForm parsed once, producing copies with patched settings
+
+    only the `settings` sheet XML is rewritten (form_id and form_title
+    cells of row 2, as inline strings); all other parts are reused."""
+
+    def __init__(self, template_path):
+        try:
+            with zipfile.ZipFile(template_path) as zf:
+                self.members = [(info, zf.read(info)) for info in zf.infolist()]
+        except (IOError, zipfile.BadZipfile):
+            raise IncorrectExcelFile("Not a proper XLSX Template.")
+        parts = {info.filename: data for info, data in self.members}
+
+        try:
+            self.sheet_path = self.find_sheet_path(parts, "settings")
+            self.sheet_xml = parts[self.sheet_path].decode("UTF-8")
+            shared_strings = self.read_shared_strings(parts)
+            self.columns = self.read_header(self.sheet_xml, shared_strings)
+        except (KeyError, ValueError, ET.ParseError) as exp:
+            raise IncorrectExcelFile("Unsupported XLSForm template: {}".format(exp))
+
+        for key in ("form_id", "form_title"):
+            if key not in self.columns:
+                raise IncorrectExcelFile("No `{}` column in settings".format(key))
+
+    @staticmethod
+    def find_sheet_path(parts, name):
+        workbook = ET.fromstring(parts["xl/workbook.xml"])
+        rels = ET.fromstring(parts["xl/_rels/workbook.xml.rels"])
+        for sheet in workbook.iterfind("main:sheets/main:sheet", NS):
+            if sheet.get("name") == name:
+                rid = sheet.get("{{{}}}id".format(NS["r"]))
+                break
+        else:
+            raise KeyError(name)
+        for rel in rels.iterfind("rels:Relationship", NS):
+            if rel.get("Id") == rid:
+                target = rel.get("Target")
+                if target.startswith("/"):
+                    return target[1:]
+                return posixpath.normpath(posixpath.join("xl", target))
+        raise KeyError(rid)
+
+    @staticmethod
+    def read_shared_strings(parts):
+        if "xl/sharedStrings.xml" not in parts:
+            return []
+        sst = ET.fromstring(parts["xl/sharedStrings.xml"])
+        return [
+            "".join([t.text or "" for t in si.iter("{{{}}}t".format(NS["main"]))])
+            for si in sst.iterfind("main:si", NS)
+        ]
+
+    @staticmethod
+    def read_header(sheet_xml, shared_strings):
+        """{header value: column letter} from first row"""
+        sheet = ET.fromstring(sheet_xml)
+        columns = {}
+        for row in sheet.iterfind("main:sheetData/main:row", NS):
+            if row.get("r") != "1":
+                continue
+            for cell in row.iterfind("main:c", NS):
+                value = cell.find("main:v", NS)
+                if cell.get("t") == "s" and value is not None:
+                    text = shared_strings[int(value.text)]
+                elif cell.get("t") == "inlineStr":
+                    text = "".join(
+                        [t.text or "" for t in cell.iter("{{{}}}t".format(NS["main"]))]
+                    )
+                elif value is not None:
+                    text = value.text
+                else:
+                    continue
+                columns[text] = re.sub(r"[0-9]", "", cell.get("r"))
+        return columns
+
+    def patch_sheet(self, values):
+        """settings sheet XML with row 2 cells set to values {key: text}"""
+        new_cells = {
+            self.columns[key]: '<c r="{col}2" t="inlineStr"><is>'
+            '<t xml:space="preserve">{text}</t></is></c>'.format(
+                col=self.columns[key], text=escape(value)
+            )
+            for key, value in values.items()
+        }
+
+        def build_row(cells):
+            return '<row r="2">{}</row>'.format(
+                "".join([cells[col] for col in sorted(cells, key=letter_to_column)])
+            )
+
+        row_match = re.search(
+            r"<row [^>]*?r=\"2\"[^>]*?(/>|>(.*?)</row>)", self.sheet_xml, re.S
+        )
+        if row_match:
+            cells = {
+                cell.group(1): cell.group(0)
+                for cell in re.finditer(
+                    r"<c [^>]*?r=\"([A-Z]+)2\"[^>]*?(?:/>|>.*?</c>)",
+                    row_match.group(2) or "",
+                    re.S,
+                )
+            }
+            cells.update(new_cells)
+            row = build_row(cells)
+            sheet_xml = "".join(
+                [
+                    self.sheet_xml[: row_match.start()],
+                    row,
+                    self.sheet_xml[row_match.end() :],
+                ]
+            )
+        else:
+            row = build_row(new_cells)
+            header = re.search(
+                r"<row [^>]*?r=\"1\"[^>]*?>.*?</row>", self.sheet_xml, re.S
+            )
+            if header is None:
+                raise IncorrectExcelFile("No header row in settings")
+            sheet_xml = "".join(
+                [self.sheet_xml[: header.end()], row, self.sheet_xml[header.end() :]]
+            )
+
+        # make sure declared dimension covers row 2
+        return re.sub(
+            r'(<dimension ref="[A-Z]+[0-9]+:[A-Z]+)1"', r'\g<1>2"', sheet_xml, count=1
+        )
+
+    def render(self, form_id, form_title):
+        sheet_xml = self.patch_sheet({"form_id": form_id, "form_title": form_title})
+        xform = io.BytesIO()
+        with zipfile.ZipFile(xform, "w") as zf:
+            for info, data in self.members:
+                if info.filename == self.sheet_path:
+                    data = sheet_xml.encode("UTF-8")
+                zf.writestr(info, data)
+        xform.seek(0)  # make sure it's readable before returning
+        return xform
+
+
+def get_xlsform_template(template_path):
+    """parsed template, re-read only if file changed since"""
+    mtime = os.path.getmtime(template_path)
+    with _templates_lock:
+        cached = _templates.get(template_path)
+        if cached is None or cached[0] != mtime:
+            cached = (mtime, XLSFormTemplate(template_path))
+            _templates[template_path] = cached
+        return cached[1]
+
 
 def gen_xlsform(template_path, form_title, form_id):
+    try:
+        template = get_xlsform_template(template_path)
+    except IncorrectExcelFile as exp:
+        logger.warning("Using openpyxl for {}: {}".format(template_path, exp))
+        return gen_xlsform_openpyxl(template_path, form_title, form_id)
+    return template.render(form_id=form_id, form_title=form_title)
+
+
+def gen_xlsform_openpyxl(template_path, form_title, form_id):
     try:
         wb = load_workbook(template_path)
     except InvalidFileException:
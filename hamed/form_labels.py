@@ -2,13 +2,24 @@
 # -*- coding: utf-8 -*-
 # vim: ai ts=4 sts=4 et sw=4 nu
 
+import os
+import json
+import hashlib
 import logging
-from pyxform.builder import create_survey_from_xls
+import tempfile
+
+from django.conf import settings
 
 logger = logging.getLogger(__name__)
 
+XLSFORM_PATH = "hamed/fixtures/enquete-sociale-mobile.xlsx"
+_labels = None
+
 
 def build_form_labels(xlsform_path):
+    # pyxform is slow to import, only needed when (re)building
+    from pyxform.builder import create_survey_from_xls
+
     # read XLSForm and feed PyXForm
     with open(xlsform_path, "rb") as f:
         xlsform = create_survey_from_xls(f)
@@ -43,8 +54,66 @@ def build_form_labels(xlsform_path):
     return labels
 
 
-LABELS = build_form_labels("hamed/fixtures/enquete-sociale-mobile.xlsx")
+def get_xlsform_signature(xlsform_path):
+    """mtime and hash of the XLSForm, identifying a labels cache"""
+    with open(xlsform_path, "rb") as f:
+        digest = hashlib.sha1(f.read()).hexdigest()
+    return {"mtime": os.path.getmtime(xlsform_path), "sha1": digest}
+
+
+def load_cached_form_labels(xlsform_path, cache_path):
+    """labels from cache file if it matches the XLSForm, None otherwise"""
+    try:
+        with open(cache_path, "r", encoding="UTF-8") as f:
+            cache = json.load(f)
+    except (IOError, ValueError):
+        return None
+
+    # mtime is a quick check, hash covers touched-but-identical files
+    signature = cache.get("signature", {})
+    if signature.get("mtime") != os.path.getmtime(xlsform_path):
+        if signature.get("sha1") != get_xlsform_signature(xlsform_path)["sha1"]:
+            return None
+    return cache.get("labels")
+
+
+def rebuild_form_labels_cache(xlsform_path=XLSFORM_PATH, cache_path=None):
+    """parse XLSForm and write its labels to the cache file"""
+    if cache_path is None:
+        cache_path = settings.FORM_LABELS_CACHE
+    labels = build_form_labels(xlsform_path)
+    # written aside then renamed: readers never see a partial file
+    fd, tmp_path = tempfile.mkstemp(
+        dir=os.path.dirname(os.path.abspath(cache_path)), suffix=".tmp"
+    )
+    try:
+        with open(fd, "w", encoding="UTF-8") as f:
+            json.dump(
+                {"signature": get_xlsform_signature(xlsform_path), "labels": labels},
+                f,
+            )
+        os.replace(tmp_path, cache_path)
+    except Exception:
+        os.remove(tmp_path)
+        raise
+    return labels
+
+
+def get_labels():
+    """form labels, parsed on first use only if cache is missing or stale"""
+    global _labels
+    if _labels is None:
+        labels = load_cached_form_labels(XLSFORM_PATH, settings.FORM_LABELS_CACHE)
+        if labels is None:
+            logger.info("Form labels cache outdated. Rebuilding.")
+            try:
+                labels = rebuild_form_labels_cache()
+            except IOError as exp:
+                logger.exception(exp)
+                labels = build_form_labels(XLSFORM_PATH)
+        _labels = labels
+    return _labels
 
 
 def get_label_for(question, value):
-    return LABELS.get(question, {}).get(value)
+    return get_labels().get(question, {}).get(value)
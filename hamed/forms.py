@@ -0,0 +1,27 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim: ai ts=4 sts=4 et sw=4 nu
+
+import logging
+
+from django import forms
+
+from hamed.models.collects import Collect
+from hamed.models.settings import Settings
+from hamed.locations import get_communes
+
+logger = logging.getLogger(__name__)
+
+
+class NewCollectForm(forms.ModelForm):
+    class Meta:
+        model = Collect
+        fields = ["commune_id", "suffix", "mayor_title", "mayor_name"]
+
+    def __init__(self, *args, **kwargs):
+        super(NewCollectForm, self).__init__(*args, **kwargs)
+
+        cercle_id = Settings.cercle_id()
+        self.fields["commune_id"] = forms.ChoiceField(
+            label="Commune", choices=get_communes(cercle_id)
+        )
@@ -4,10 +4,14 @@
 
 import math
 import random
+import logging
+import itertools
 
 CHARACTERS_POOL = "23456789ABCDEFGHJKMNPRSTWXYZ"
 ID_LENGTH = 4
 
+logger = logging.getLogger(__name__)
+
 
 def checkdigit_for(id_without_check):
 
@@ -62,7 +66,92 @@ def base_random_id(length=ID_LENGTH, pool=CHARACTERS_POOL):
     return "".join([random.choice(pool) for i in range(length)])
 
 
+def full_id_for(base):
+    return "{base}{cdigit}".format(base=base, cdigit=checkdigit_for(base))
+
+
 def full_random_id():
-    base = base_random_id()
-    check_digit = checkdigit_for(base)
-    return "{base}{cdigit}".format(base=base, cdigit=check_digit)
+    return full_id_for(base_random_id())
+
+
+class IdentifierAllocator(object):
+    """hands out fresh, check-digit-valid identifiers in batches
+
+    used identifiers are given once upfront so no lookup is needed per
+    identifier. When the space gets crowded, random picking (and its
+    growing number of retries) is replaced by drawing from the list of
+    remaining free identifiers."""
+
+    # fullness above which free identifiers are enumerated
+    ENUMERATION_THRESHOLD = 0.5
+
+    def __init__(self, used=[], length=ID_LENGTH, pool=CHARACTERS_POOL):
+        self.length = length
+        self.pool = pool
+        self.capacity = len(pool) ** length
+        self.used = set(used)
+
+    @property
+    def nb_used(self):
+        return len(self.used)
+
+    @property
+    def nb_free(self):
+        return max(self.capacity - self.nb_used, 0)
+
+    @property
+    def fullness(self):
+        return self.nb_used / self.capacity
+
+    def stats(self):
+        return {
+            "used": self.nb_used,
+            "free": self.nb_free,
+            "capacity": self.capacity,
+            "fullness": self.fullness,
+        }
+
+    def reserve(self, identifiers):
+        """those of identifiers not in use (now reserved)"""
+        free = [ident for ident in identifiers if ident not in self.used]
+        self.used.update(free)
+        return free
+
+    def allocate(self, nb):
+        """list of nb identifiers, distinct and not in use (now reserved)"""
+        if nb > self.nb_free:
+            raise Exception(
+                "Not enough free identifiers: {nb} requested, {free} left.".format(
+                    nb=nb, free=self.nb_free
+                )
+            )
+
+        if (self.nb_used + nb) / self.capacity < self.ENUMERATION_THRESHOLD:
+            idents = self._allocate_random(nb)
+        else:
+            idents = self._allocate_enumerated(nb)
+
+        self.used.update(idents)
+        if self.fullness > 0.8:
+            logger.warning("Identifiers space is {:.0%} full".format(self.fullness))
+        return idents
+
+    def _allocate_random(self, nb):
+        # less than half the space is used: each draw succeeds with p > .5
+        idents = set()
+        while len(idents) < nb:
+            ident = full_id_for(base_random_id(self.length, self.pool))
+            if ident not in self.used:
+                idents.add(ident)
+        return list(idents)
+
+    def _allocate_enumerated(self, nb):
+        free = [
+            ident
+            for ident in (
+                full_id_for("".join(chars))
+                for chars in itertools.product(self.pool, repeat=self.length)
+            )
+            if ident not in self.used
+        ]
+        return random.sample(free, nb)
@@ -0,0 +1,73 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim: ai ts=4 sts=4 et sw=4 nu
+
+import os
+import logging
+import tempfile
+
+import humanfriendly
+from path import Path as P
+from django.core.management.base import BaseCommand, CommandError
+
+from hamed.models.collects import Collect
+from hamed.utils import list_files_sizes
+from hamed.usb import export_collect_tree, FILES_MODE, ARCHIVE_MODE, COMPRESSIONS
+
+logger = logging.getLogger(__name__)
+
+
+class Command(BaseCommand):
+    help = "Compare file-by-file and archive USB exports of a collect"
+
+    def add_arguments(self, parser):
+        parser.add_argument("collect_id", type=int, help="collect to export")
+        parser.add_argument(
+            "destination", help="folder on the mounted USB stick (emptied after)"
+        )
+
+    def handle(self, *args, **kwargs):
+        collect = Collect.get_or_none(kwargs.get("collect_id"))
+        if collect is None:
+            raise CommandError("No collect with ID {}".format(kwargs["collect_id"]))
+        if not P(kwargs.get("destination")).isdir():
+            raise CommandError("{} is not a folder".format(kwargs["destination"]))
+
+        src = collect.get_documents_path()
+        files_sizes = list_files_sizes(src)
+        self.stdout.write(
+            "{nb} files, {size}".format(
+                nb=len(files_sizes),
+                size=humanfriendly.format_size(sum([s for _, s in files_sizes])),
+            )
+        )
+
+        runs = [(FILES_MODE, None)] + [(ARCHIVE_MODE, c) for c in COMPRESSIONS.keys()]
+        for mode, compression in runs:
+            dst = tempfile.mkdtemp(prefix="bench-", dir=kwargs.get("destination"))
+            try:
+                stats = export_collect_tree(
+                    src, dst, files_sizes, mode=mode, compression=compression
+                )
+                written = sum(
+                    [
+                        os.path.getsize(os.path.join(root, fname))
+                        for root, _, fnames in os.walk(dst)
+                        for fname in fnames
+                    ]
+                )
+            finally:
+                P(dst).rmtree_p()
+
+            self.stdout.write(
+                "{mode:<8} {compression:<8} {d:>7.1f}s (sync {sd:.1f}s) "
+                "{speed:>10}/s, {written} written, {errors} error(s)".format(
+                    mode=mode,
+                    compression=compression or "-",
+                    d=stats["duration"],
+                    sd=stats["sync_duration"],
+                    speed=humanfriendly.format_size(stats["throughput"]),
+                    written=humanfriendly.format_size(written),
+                    errors=len(stats["errors"]),
+                )
+            )
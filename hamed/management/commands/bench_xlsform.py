@@ -0,0 +1,57 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim: ai ts=4 sts=4 et sw=4 nu
+
+import timeit
+import logging
+
+from django.core.management.base import BaseCommand
+
+from hamed.exports.xlsx.xlsform import (
+    gen_xlsform,
+    gen_xlsform_openpyxl,
+    get_xlsform_template,
+)
+
+logger = logging.getLogger(__name__)
+
+TEMPLATES = (
+    "hamed/fixtures/enquete-sociale-mobile.xlsx",
+    "hamed/fixtures/scan-certificat.xlsx",
+)
+
+
+class Command(BaseCommand):
+    help = "Compare cached-template and openpyxl XLSForm generation"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "-n", "--iterations", type=int, default=20, help="runs per method"
+        )
+
+    def handle(self, *args, **kwargs):
+        nb = kwargs.get("iterations")
+        for template_path in TEMPLATES:
+            # first parse is not part of the per-form cost
+            get_xlsform_template(template_path)
+
+            results = {}
+            for name, func in (
+                ("template", gen_xlsform),
+                ("openpyxl", gen_xlsform_openpyxl),
+            ):
+                duration = timeit.timeit(
+                    lambda: func(template_path, form_title="Bench", form_id="bench"),
+                    number=nb,
+                )
+                results[name] = duration / nb
+
+            self.stdout.write(
+                "{path}: template {tpl:.1f}ms, openpyxl {opx:.1f}ms "
+                "(x{ratio:.1f})".format(
+                    path=template_path,
+                    tpl=results["template"] * 1000,
+                    opx=results["openpyxl"] * 1000,
+                    ratio=results["openpyxl"] / results["template"],
+                )
+            )
@@ -0,0 +1,24 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim: ai ts=4 sts=4 et sw=4 nu
+
+import logging
+
+from django.core.management.base import BaseCommand
+from django.conf import settings
+
+from hamed.form_labels import rebuild_form_labels_cache, XLSFORM_PATH
+
+logger = logging.getLogger(__name__)
+
+
+class Command(BaseCommand):
+    help = "Rebuild the form labels cache from the social survey XLSForm"
+
+    def handle(self, *args, **kwargs):
+        labels = rebuild_form_labels_cache()
+        logger.info(
+            "Wrote {nb} questions labels from {src} to {dst}".format(
+                nb=len(labels), src=XLSFORM_PATH, dst=settings.FORM_LABELS_CACHE
+            )
+        )
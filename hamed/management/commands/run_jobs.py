@@ -0,0 +1,45 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim: ai ts=4 sts=4 et sw=4 nu
+
+import time
+import logging
+
+from django.core.management.base import BaseCommand
+
+from hamed.models.jobs import Job
+
+logger = logging.getLogger(__name__)
+
+
+class Command(BaseCommand):
+    help = "Worker running queued collect jobs (start, end, finalize, reopen)"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--interval",
+            type=float,
+            default=1,
+            help="Seconds between checks for new jobs.",
+        )
+        parser.add_argument(
+            "--once",
+            action="store_true",
+            default=False,
+            help="Exit once there is no pending job.",
+        )
+
+    def handle(self, *args, **kwargs):
+        nb_interrupted = Job.fail_interrupted()
+        if nb_interrupted:
+            logger.warning("{} interrupted job(s) marked failed".format(nb_interrupted))
+
+        logger.info("Waiting for jobs…")
+        while True:
+            job = Job.claim_next()
+            if job is not None:
+                job.run()
+                continue
+            if kwargs.get("once"):
+                break
+            time.sleep(kwargs.get("interval"))
@@ -5,16 +5,29 @@
 import logging
 import signal
 import json
-import os
+import time
 import threading
 
+import humanfriendly
 from path import Path as P
 from SimpleWebSocketServer import WebSocket, SimpleWebSocketServer
 from django.core.management.base import BaseCommand
 from django.conf import settings
 
 from hamed.models.collects import Collect
-from hamed.utils import list_files, find_export_disk, prepare_disk, unmount_device
+from hamed.utils import (
+    list_files_sizes,
+    find_export_disk,
+    prepare_disk,
+    unmount_device,
+)
+from hamed.usb import (
+    export_collect_tree,
+    verify_export,
+    MODES,
+    FILES_MODE,
+    COMPRESSIONS,
+)
 
 FAILED = "failed"
 SUCCESS = "success"
@@ -31,22 +44,71 @@ def pgresponse(pc, message, status=IN_PROGRESS):
 
 
 class CopyProgressTicker(object):
-    def __init__(self, nb_expected, client):
+    """progress of a copy based on bytes, sent at most USB_PROGRESS_RATE/s
+
+    ticks come from the writer threads."""
+
+    def __init__(self, nb_expected, nb_bytes_expected, client, start=0, end=100):
         self.nb_copied = 0
         self.nb_expected = nb_expected
+        self.nb_bytes_copied = 0
+        self.nb_bytes_expected = nb_bytes_expected
         self.client = client
-
-    def tick(self, filename):
+        # range of the overall progress covered by the copy
+        self.start = start
+        self.end = end
+        self.lock = threading.Lock()
+        self.started = time.monotonic()
+        self.last_sent = 0
+
+    def tick(self, filename, nb_bytes=0, error=None):
         logger.debug("TICK {}".format(filename))
-        self.client.sendMessage(
-            pgresponse(
-                self.percentage(), "Copie de {}".format(filename), status="in-progress"
+        with self.lock:
+            self.nb_copied += 1
+            self.nb_bytes_copied += nb_bytes
+            now = time.monotonic()
+            if (
+                now - self.last_sent < 1 / settings.USB_PROGRESS_RATE
+                and self.nb_copied < self.nb_expected
+            ):
+                return
+            self.last_sent = now
+            self.client.sendMessage(
+                pgresponse(self.percentage(), self.message(filename), IN_PROGRESS)
             )
-        )
-        self.nb_copied += 1
+
+    @property
+    def ratio(self):
+        if not self.nb_bytes_expected:
+            return self.nb_copied / self.nb_expected if self.nb_expected else 1
+        return self.nb_bytes_copied / self.nb_bytes_expected
+
+    @property
+    def throughput(self):
+        duration = time.monotonic() - self.started
+        return self.nb_bytes_copied / duration if duration else 0
+
+    @property
+    def eta(self):
+        """estimated remaining seconds or None"""
+        if not self.throughput:
+            return None
+        return (self.nb_bytes_expected - self.nb_bytes_copied) / self.throughput
 
     def percentage(self):
-        return (self.nb_copied / self.nb_expected) * 100
+        return self.start + (self.end - self.start) * self.ratio
+
+    def message(self, filename):
+        if self.nb_copied >= self.nb_expected:
+            return "Finalisation de l'écriture sur le disque USB…"
+        eta = self.eta
+        return "Copie de {fname} ({nb}/{total}) – {speed}/s, reste {eta}".format(
+            fname=filename,
+            nb=self.nb_copied,
+            total=self.nb_expected,
+            speed=humanfriendly.format_size(self.throughput),
+            eta=humanfriendly.format_timespan(eta) if eta is not None else "?",
+        )
 
 
 class USBExportProgress(WebSocket):
@@ -54,6 +116,9 @@ class USBExportProgress(WebSocket):
         self.collect = None
         self.device_path = None
         self.mount_point = None
+        self.mode = FILES_MODE
+        self.compression = None
+        self.verify = False
 
         self.percent = 0
         self.status = IN_PROGRESS
@@ -92,7 +157,17 @@ class USBExportProgress(WebSocket):
             if self.collect is None:
                 self.fail("Aucune collecte avec cet ID `{}`".format(collect_id))
                 return
-            logger.info("Received start request for {}".format(self.collect))
+            self.mode = jsd.get("mode") or FILES_MODE
+            self.compression = jsd.get("compression")
+            self.verify = bool(jsd.get("verify"))
+            if self.mode not in MODES or (
+                self.compression and self.compression not in COMPRESSIONS
+            ):
+                self.fail("Mode d'export inconnu `{}`".format(self.mode))
+                return
+            logger.info(
+                "Received start request for {} ({})".format(self.collect, self.mode)
+            )
 
             self.up_inform(1, IN_PROGRESS, "Préparation de la copie")
 
@@ -106,7 +181,8 @@ class USBExportProgress(WebSocket):
 
         # get device name of the sole USB disk
         try:
-            self.device_path = find_export_disk()
+            # about to be formatted: don't trust a cached inventory
+            self.device_path = find_export_disk(refresh=True)
         except Exception as exp:
             logger.exception(exp)
             self.fail(exp)
@@ -137,27 +213,48 @@ class USBExportProgress(WebSocket):
 
         src = self.collect.get_documents_path()
         dst = self.mount_point
-        all_files = list_files(src)
-        ticker = CopyProgressTicker(nb_expected=len(all_files), client=self)
+        files_sizes = list_files_sizes(src)
+        all_files = [fname for fname, _ in files_sizes]
+        ticker = CopyProgressTicker(
+            nb_expected=len(all_files),
+            nb_bytes_expected=sum([size for _, size in files_sizes]),
+            client=self,
+            start=15,
+            end=90 if self.verify else 99,
+        )
 
-        errors = []
         self.up_inform(15, IN_PROGRESS, "Copie des fichiers en cours…")
         logger.debug("Starting file copy")
 
-        for index, filename in enumerate(all_files):
-            ticker.tick(filename=filename)
-            df = P(os.path.join(dst, filename))
-            df.parent.makedirs_p()
-            try:
-                P(os.path.join(src, filename)).copy2(df)
-            except Exception as exp:
-                logger.exception(exp)
-                errors.append((filename, exp))
+        try:
+            stats = export_collect_tree(
+                src,
+                dst,
+                files_sizes,
+                mode=self.mode,
+                compression=self.compression,
+                on_copied=ticker.tick,
+            )
+        except Exception as exp:
+            logger.exception(exp)
+            stats = {"errors": [("", exp)]}
+
+        errors = stats["errors"]
+        if self.verify and "manifest" in stats:
+            errors += self.verify_files(dst, stats["manifest"])
         if len(errors) == 0:
             self.up_inform(
                 100,
                 SUCCESS,
-                "Copie terminée avec succès: {} fichiers.".format(ticker.nb_expected),
+                "Copie terminée avec succès: {nb} fichiers{archives} "
+                "({size} à {speed}/s).".format(
+                    nb=ticker.nb_expected,
+                    archives=" dans {} archive(s) ZIP".format(stats["archives"])
+                    if stats.get("archives")
+                    else "",
+                    size=humanfriendly.format_size(stats["bytes"]),
+                    speed=humanfriendly.format_size(stats["throughput"]),
+                ),
             )
             logger.debug("All files copied")
         else:
@@ -172,6 +269,28 @@ class USBExportProgress(WebSocket):
         unmount_device(self.device_path)
         P(dst).removedirs_p()
 
+    def verify_files(self, dst, manifest):
+        """re-read sampled and suspect files, reporting failures as they come"""
+        self.up_inform(90, IN_PROGRESS, "Vérification de la copie…")
+
+        def on_verified(fname, error):
+            if error is not None:
+                self.inform("Fichier invalide: {f} ({exp})".format(f=fname, exp=error))
+
+        try:
+            stats = verify_export(dst, manifest, on_verified=on_verified)
+        except Exception as exp:
+            logger.exception(exp)
+            return [("", exp)]
+        self.up_inform(
+            99,
+            IN_PROGRESS,
+            "{nb} fichiers vérifiés, {nb_errors} erreur(s).".format(
+                nb=stats["files"], nb_errors=len(stats["errors"])
+            ),
+        )
+        return stats["errors"]
+
     def handleConnected(self):
         print(self.address, "connected")
         for client in clients:
@@ -0,0 +1,52 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim: ai ts=4 sts=4 et sw=4 nu
+
+import time
+import logging
+import datetime
+
+from django.utils import timezone
+from django.core.management.base import BaseCommand
+
+from hamed.models.collects import Collect
+from hamed.models.jobs import Job
+
+logger = logging.getLogger(__name__)
+
+
+class Command(BaseCommand):
+    help = "Queue import of new ONA submissions of started collects (run_jobs)"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--interval",
+            type=int,
+            default=0,
+            help="Seconds between runs. Runs once if not set.",
+        )
+
+    def handle(self, *args, **kwargs):
+        interval = kwargs.get("interval")
+        while True:
+            self.sync_all()
+            if not interval:
+                break
+            time.sleep(interval)
+
+    def sync_all(self):
+        # syncs are run by the run_jobs worker so they never overlap with
+        # another operation (end…) on the same collect
+        # collects with a suspended end are left alone (form is disabled)
+        for collect in Collect.active.filter(
+            status=Collect.STARTED, ona_form_pk__isnull=False, checkpoints__isnull=True
+        ):
+            job = Job.enqueue(Job.SYNC, collect=collect)
+            logger.debug("{job} for {collect}".format(job=job, collect=collect))
+
+        # only keep a day of successful syncs
+        Job.objects.filter(
+            kind=Job.SYNC,
+            status=Job.SUCCESS,
+            ended_on__lt=timezone.now() - datetime.timedelta(days=1),
+        ).delete()
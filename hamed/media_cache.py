@@ -0,0 +1,104 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim: ai ts=4 sts=4 et sw=4 nu
+
+import os
+import time
+import hashlib
+import logging
+import threading
+from contextlib import contextmanager
+
+from path import Path as P
+from django.conf import settings
+
+from hamed.ona import download_media_to
+
+logger = logging.getLogger(__name__)
+
+_cache = None
+
+
+class MediaCache(object):
+    """size-bounded on-disk cache of ONA medias, keyed by ONA filename
+
+    entries are evicted least-recently-used first. Access time is set
+    explicitly on hits (mtime stays the download time) so it doesn't
+    depend on the filesystem's atime mount options."""
+
+    def __init__(self, folder, max_size):
+        self.folder = folder
+        self.max_size = max_size
+        self.lock = threading.Lock()
+        # {fpath: (lock, nb of users)}, removed once unused. Files being
+        # fetched are never evicted.
+        self.key_locks = {}
+
+    def get_fpath(self, key):
+        ext = os.path.splitext(key)[1]
+        digest = hashlib.sha1(key.encode("UTF-8")).hexdigest()
+        return os.path.join(self.folder, "{}{}".format(digest, ext))
+
+    @contextmanager
+    def key_lock(self, fpath):
+        with self.lock:
+            lock, nb_users = self.key_locks.get(fpath, (threading.Lock(), 0))
+            self.key_locks[fpath] = (lock, nb_users + 1)
+        try:
+            with lock:
+                yield
+        finally:
+            with self.lock:
+                lock, nb_users = self.key_locks[fpath]
+                if nb_users > 1:
+                    self.key_locks[fpath] = (lock, nb_users - 1)
+                else:
+                    del self.key_locks[fpath]
+
+    def fetch(self, url, key, expected_size=None):
+        """open (binary) file of the cached copy of media at url
+
+        media is downloaded on miss. File is opened before any eviction so
+        it remains readable even if evicted meanwhile. Caller closes it."""
+        fpath = self.get_fpath(key)
+
+        # concurrent requests for the same media download it only once
+        with self.key_lock(fpath):
+            if os.path.exists(fpath):
+                os.utime(fpath, (time.time(), os.stat(fpath).st_mtime))
+                return open(fpath, "rb")
+
+            P(self.folder).makedirs_p()
+            download_media_to(url, fpath, expected_size)
+            fd = open(fpath, "rb")
+
+        self.evict(keep=fpath)
+        return fd
+
+    def evict(self, keep=None):
+        """remove least recently used entries (but keep) until under max_size"""
+        with self.lock:
+            entries = [
+                (entry.stat().st_atime, entry.stat().st_size, entry.path)
+                for entry in os.scandir(self.folder)
+                if entry.is_file()
+                and not entry.name.startswith(".")
+                and entry.path != keep
+                and entry.path not in self.key_locks
+            ]
+            total_size = sum([size for _, size, _ in entries])
+            for _, size, fpath in sorted(entries):
+                if total_size <= self.max_size:
+                    break
+                logger.debug("Evicting {} from media cache".format(fpath))
+                P(fpath).remove_p()
+                total_size -= size
+
+
+def get_media_cache():
+    global _cache
+    if _cache is None:
+        _cache = MediaCache(
+            folder=settings.MEDIA_CACHE_FOLDER, max_size=settings.MEDIA_CACHE_MAX_SIZE
+        )
+    return _cache
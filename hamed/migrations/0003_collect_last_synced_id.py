@@ -0,0 +1,20 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.10.5 on 2026-10-18 09:12
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("hamed", "0002_auto_20170414_1406"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="collect",
+            name="last_synced_id",
+            field=models.IntegerField(blank=True, null=True),
+        ),
+    ]
@@ -0,0 +1,76 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.10.5 on 2026-10-18 10:41
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+import jsonfield.fields
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("hamed", "0003_collect_last_synced_id"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="Job",
+            fields=[
+                (
+                    "id",
+                    models.AutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                (
+                    "kind",
+                    models.CharField(
+                        choices=[
+                            ("start", "Création de la collecte"),
+                            ("end", "Cloture de la collecte"),
+                            ("finalize", "Finalisation de la collecte"),
+                            ("reopen", "Ré-ouverture de la collecte"),
+                        ],
+                        max_length=50,
+                    ),
+                ),
+                (
+                    "status",
+                    models.CharField(
+                        choices=[
+                            ("pending", "En attente"),
+                            ("running", "En cours"),
+                            ("success", "Terminé"),
+                            ("failed", "Échec"),
+                        ],
+                        default="pending",
+                        max_length=50,
+                    ),
+                ),
+                ("payload", jsonfield.fields.JSONField(blank=True, default=dict)),
+                ("created_on", models.DateTimeField(auto_now_add=True)),
+                ("started_on", models.DateTimeField(blank=True, null=True)),
+                ("ended_on", models.DateTimeField(blank=True, null=True)),
+                ("progress", models.FloatField(default=0)),
+                ("step", models.CharField(blank=True, max_length=100, null=True)),
+                ("message", models.TextField(blank=True, null=True)),
+                (
+                    "collect",
+                    models.ForeignKey(
+                        blank=True,
+                        null=True,
+                        on_delete=django.db.models.deletion.SET_NULL,
+                        related_name="jobs",
+                        to="hamed.Collect",
+                    ),
+                ),
+            ],
+            options={
+                "ordering": ["-created_on"],
+            },
+        ),
+    ]
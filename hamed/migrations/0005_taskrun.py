@@ -0,0 +1,63 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.10.5 on 2026-10-18 11:27
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+import jsonfield.fields
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("hamed", "0004_job"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="TaskRun",
+            fields=[
+                (
+                    "id",
+                    models.AutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("collection", models.CharField(max_length=100)),
+                ("task", models.CharField(max_length=100)),
+                ("index", models.IntegerField()),
+                ("status", models.CharField(max_length=50)),
+                ("started_on", models.DateTimeField(blank=True, null=True)),
+                ("wall_time", models.FloatField(blank=True, null=True)),
+                ("cpu_time", models.FloatField(blank=True, null=True)),
+                ("peak_memory", models.BigIntegerField(blank=True, null=True)),
+                ("counts", jsonfield.fields.JSONField(blank=True, default=dict)),
+                (
+                    "collect",
+                    models.ForeignKey(
+                        blank=True,
+                        null=True,
+                        on_delete=django.db.models.deletion.SET_NULL,
+                        related_name="task_runs",
+                        to="hamed.Collect",
+                    ),
+                ),
+                (
+                    "job",
+                    models.ForeignKey(
+                        blank=True,
+                        null=True,
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name="task_runs",
+                        to="hamed.Job",
+                    ),
+                ),
+            ],
+            options={
+                "ordering": ["job", "index"],
+            },
+        ),
+    ]
@@ -0,0 +1,50 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.10.5 on 2026-10-18 12:03
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+import jsonfield.fields
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("hamed", "0005_taskrun"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="TaskCheckpoint",
+            fields=[
+                (
+                    "id",
+                    models.AutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("collection", models.CharField(max_length=100)),
+                ("completed", jsonfield.fields.JSONField(blank=True, default=list)),
+                ("outputs", models.BinaryField()),
+                ("updated_on", models.DateTimeField(auto_now=True)),
+                (
+                    "collect",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name="checkpoints",
+                        to="hamed.Collect",
+                    ),
+                ),
+            ],
+            options={
+                "ordering": ["-updated_on"],
+            },
+        ),
+        migrations.AlterUniqueTogether(
+            name="taskcheckpoint",
+            unique_together=set([("collect", "collection")]),
+        ),
+    ]
@@ -0,0 +1,29 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.10.5 on 2026-10-18 16:02
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("hamed", "0006_taskcheckpoint"),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name="job",
+            name="kind",
+            field=models.CharField(
+                choices=[
+                    ("start", "Création de la collecte"),
+                    ("end", "Cloture de la collecte"),
+                    ("finalize", "Finalisation de la collecte"),
+                    ("reopen", "Ré-ouverture de la collecte"),
+                    ("sync", "Synchronisation de la collecte"),
+                ],
+                max_length=50,
+            ),
+        ),
+    ]
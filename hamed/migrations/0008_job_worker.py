@@ -0,0 +1,20 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.10.5 on 2026-10-18 16:40
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("hamed", "0007_job_sync_kind"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="job",
+            name="worker",
+            field=models.CharField(blank=True, max_length=100, null=True),
+        ),
+    ]
@@ -7,5 +7,8 @@ import logging
 from hamed.models.settings import Settings
 from hamed.models.collects import Collect
 from hamed.models.targets import Target
+from hamed.models.jobs import Job
+from hamed.models.task_runs import TaskRun
+from hamed.models.task_checkpoints import TaskCheckpoint
 
 logger = logging.getLogger(__name__)
@@ -3,16 +3,23 @@
 # vim: ai ts=4 sts=4 et sw=4 nu
 
 import os
+import json
+import time
 import logging
 from collections import OrderedDict
 from statistics import median, StatisticsError
 
-from django.db import models
+from django.db import models, transaction
 from django.urls import reverse
 from django.conf import settings
 from django.utils import timezone
 
-from hamed.utils import gen_targets_csv
+from hamed.utils import (
+    gen_targets_csv,
+    gen_targets_documents,
+    load_documents_manifest,
+    chunks,
+)
 from hamed.models.targets import Target
 from hamed.models.settings import Settings
 from hamed.steps.start_collect import StartCollectTaskCollection
@@ -112,6 +119,9 @@ class Collect(models.Model):
     medias_size_form = models.IntegerField(blank=True, null=True)
     medias_size_scan_form = models.IntegerField(blank=True, null=True)
 
+    # ONA `_id` of the last submission imported as Target
+    last_synced_id = models.IntegerField(blank=True, null=True)
+
     objects = models.Manager()
     active = ActiveCollectManager()
     archived = ArchivedCollectManager()
@@ -268,7 +278,8 @@ class Collect(models.Model):
             return
 
         # create task collection
-        tc = self.machine_value_for(self.sm_index + 1)[1](collect=self)
+        tc_cls = self.machine_value_for(self.sm_index + 1)[1]
+        tc = tc_cls(collect=self, checkpoint=self.get_checkpoint_store(tc_cls))
         tc.process()
         return tc
 
@@ -277,10 +288,19 @@ class Collect(models.Model):
         if self.sm_index < 0:
             return
 
-        tc = self.machine_value_for(self.sm_index)[1](collect=self)
+        tc_cls = self.machine_value_for(self.sm_index)[1]
+        tc = tc_cls(collect=self, checkpoint=self.get_checkpoint_store(tc_cls))
         tc.revert_all()
         return tc
 
+    def get_checkpoint_store(self, collection_cls):
+        """checkpoint store for a resumable TaskCollection on this collect"""
+        from hamed.models.task_checkpoints import CheckpointStore
+
+        if not collection_cls.resumable:
+            return None
+        return CheckpointStore(self, collection_cls.__name__)
+
     def transform_to(self, new_status):
         # unable to move to non-existing state
         assert new_status in STATUSES().keys()
@@ -343,28 +363,163 @@ class Collect(models.Model):
         self.status = new_status
         self.save()
 
+    @staticmethod
+    def probe_attachments_sizes(submissions, trust_metadata=None):
+        """set `filesize` on all submissions' attachments in a single batch
+
+        sizes already advertised by ONA are reused unless trust_metadata
+        is False. Returns counters of network probes done and avoided."""
+        from hamed.ona import get_media_sizes, get_attachment_size
+
+        if trust_metadata is None:
+            trust_metadata = settings.ONA_TRUST_ATTACHMENTS_METADATA
+
+        to_probe = []
+        nb_avoided = 0
+        for submission in submissions:
+            for media in submission.get("_attachments", []):
+                size = get_attachment_size(media) if trust_metadata else None
+                if size is None:
+                    to_probe.append(media)
+                else:
+                    media["filesize"] = size
+                    nb_avoided += 1
+
+        # a filename shared by several attachments is requested once
+        sizes = get_media_sizes([media.get("filename", "") for media in to_probe])
+        for media in to_probe:
+            media["filesize"] = sizes[media.get("filename", "")]
+
+        stats = {"probed": len(sizes), "avoided": nb_avoided}
+        logger.debug("Attachments sizes: {}".format(stats))
+        return stats
+
+    def get_form_data(self):
+        """lazy ONA submissions of the form not imported yet, oldest first"""
+        from hamed.ona import LazyFormData
+
+        params = {"sort": json.dumps({"_id": 1})}
+        if self.last_synced_id is not None:
+            params["query"] = json.dumps({"_id": {"$gt": self.last_synced_id}})
+        return LazyFormData(self.ona_form_pk, params=params)
+
+    def sync_form_data(self):
+        """import new submissions and pre-render their documents"""
+        targets = self.process_form_data(self.get_form_data())
+        if targets:
+            gen_targets_documents(targets)
+        return targets
+
     def process_form_data(self, data):
-        from hamed.ona import get_media_size
+        """create Targets from submissions (any iterable, consumed by pages)
 
+        counters are incremented so data can be a delta since last sync.
+        Returns the created Targets."""
+        from hamed.ona import get_session_stats
+
+        # only those fields are changed: another instance of this collect
+        # may have been saved meanwhile
+        counters = ["nb_submissions", "nb_medias_form", "medias_size_form"]
+        self.refresh_from_db(fields=counters + ["last_synced_id"])
+
+        created = []
         nb_medias = 0
         medias_size = 0
-        for submission in data:
+        insert_duration = 0
+        allocator = Target.get_identifier_allocator()
+        # submissions imported again (reopened collect) get their former
+        # identifier back so their documents don't need to be re-rendered
+        former_idents = {
+            entry.get("submission"): ident
+            for ident, entry in load_documents_manifest(self).items()
+        }
+        for page in chunks(data, settings.ONA_DATA_PAGE_SIZE):
+            # submissions already imported (data fetched before last save)
+            if self.last_synced_id is not None:
+                page = [s for s in page if s.get("_id", 0) > self.last_synced_id]
             # get attachement filesizes
-            attachments = submission.get("_attachments", [])
-            for media in attachments:
-                media["filesize"] = get_media_size(media.get("filename", ""))
-            submission["_attachments"] = attachments
+            self.probe_attachments_sizes(page)
+
+            # a page's Targets and the sync cursor (persisted per page so an
+            # interrupted sync resumes from there) are committed together
+            started = time.monotonic()
+            with transaction.atomic():
+                # build Targets in memory and insert them all at once
+                targets = []
+                identifiers = [former_idents.get(s.get("_id")) for s in page]
+                reserved = set(allocator.reserve([i for i in identifiers if i]))
+                identifiers = [i if i in reserved else None for i in identifiers]
+                fresh = iter(allocator.allocate(identifiers.count(None)))
+                identifiers = [ident or next(fresh) for ident in identifiers]
+                for submission, identifier in zip(page, identifiers):
+                    attachments = submission.get("_attachments", [])
+                    submission["_attachments"] = attachments
+
+                    targets.append(
+                        Target.build_from_submission(self, submission, identifier)
+                    )
+
+                    nb_medias += len(attachments)
+                    medias_size += sum([m.get("filesize") or 0 for m in attachments])
+                created += Target.objects.bulk_create(targets)
+
+                ids = [s["_id"] for s in page if s.get("_id") is not None]
+                if ids:
+                    self.last_synced_id = max(ids + [self.last_synced_id or 0])
+                    self.save(update_fields=["last_synced_id"])
+            insert_duration += time.monotonic() - started
+
+        logger.info(
+            "Inserted {nb} targets in {d:.2f}s ({rate:.0f} rows/s)".format(
+                nb=len(created),
+                d=insert_duration,
+                rate=len(created) / insert_duration if insert_duration else 0,
+            )
+        )
 
-            # create Target
-            Target.create_from_submission(self, submission)
+        self.nb_submissions = self.targets.count()
+        self.nb_medias_form = (self.nb_medias_form or 0) + nb_medias
+        self.medias_size_form = (self.medias_size_form or 0) + medias_size
+        self.save(update_fields=counters)
+        logger.debug("ONA connections: {}".format(get_session_stats()))
+        return created
+
+    def get_targets_synced_after(self, last_synced_id):
+        """Targets imported after last_synced_id (None: all of them)"""
+        if last_synced_id is None:
+            return list(self.targets.all())
+        return [
+            target
+            for target in self.targets.all()
+            if target.form_dataset.get("_id", 0) > last_synced_id
+        ]
 
-            nb_medias += len(attachments)
-            medias_size += sum([m["filesize"] for m in attachments])
+    def remove_form_data_since(self, last_synced_id):
+        """delete Targets imported after last_synced_id (None: all of them)"""
+        if last_synced_id is None:
+            return self.reset_form_data()
 
-        self.nb_submissions = len(data)
+        for target in self.get_targets_synced_after(last_synced_id):
+            target.remove_completely()
+
+        nb_medias = 0
+        medias_size = 0
+        for target in self.targets.all():
+            attachments = target.form_dataset.get("_attachments", [])
+            nb_medias += len(attachments)
+            medias_size += sum([m.get("filesize") or 0 for m in attachments])
+        self.nb_submissions = self.targets.count()
         self.nb_medias_form = nb_medias
         self.medias_size_form = medias_size
-        self.save()
+        self.last_synced_id = last_synced_id
+        self.save(
+            update_fields=[
+                "nb_submissions",
+                "nb_medias_form",
+                "medias_size_form",
+                "last_synced_id",
+            ]
+        )
 
     def reset_form_data(self, delete_submissions=False):
         for target in self.targets.all():
@@ -376,33 +531,43 @@ class Collect(models.Model):
         self.nb_medias_scan_form = None
         self.medias_size_form = None
         self.medias_size_scan_form = None
+        self.last_synced_id = None
         self.save()
 
     def process_scan_form_data(self, data):
-        from hamed.ona import get_media_size
+        """update Targets with scan submissions (any iterable, by pages)
+
+        Returns the number of scan submissions matching a Target."""
+        from hamed.ona import get_session_stats
 
+        nb_scans = 0
         nb_medias = 0
         medias_size = 0
-        for submission in data:
-            # find target and mark as indigent
-            target = Target.get_or_none(submission.get("ident"))
-            if target is None:
-                logger.error(
-                    "IDENT #{} is not in a target".format(submission.get("ident"))
-                )
-                continue
+        for page in chunks(data, settings.ONA_DATA_PAGE_SIZE):
+            # find targets first so we only size attachments we'll keep
+            matches = []
+            for submission in page:
+                target = Target.get_or_none(submission.get("ident"))
+                if target is None:
+                    logger.error(
+                        "IDENT #{} is not in a target".format(submission.get("ident"))
+                    )
+                    continue
+                matches.append((target, submission))
 
             # include new attachments to counters
-            attachments = submission.get("_attachments", [])
-            for media in attachments:
-                media["filesize"] = get_media_size(media.get("filename", ""))
-            submission["_attachments"] = attachments
+            self.probe_attachments_sizes([submission for _, submission in matches])
 
-            # update target
-            target.update_with_scan_submission(submission)
+            for target, submission in matches:
+                attachments = submission.get("_attachments", [])
+                submission["_attachments"] = attachments
 
-            nb_medias += len(attachments)
-            medias_size += sum([m["filesize"] for m in attachments])
+                # update target (mark as indigent)
+                target.update_with_scan_submission(submission)
+                nb_scans += 1
+
+                nb_medias += len(attachments)
+                medias_size += sum([m.get("filesize") or 0 for m in attachments])
 
         self.nb_medias_scan_form = nb_medias
         self.medias_size_scan_form = medias_size
@@ -418,6 +583,8 @@ class Collect(models.Model):
         self.nb_indigents = self.indigents.count()
         self.nb_non_indigents = self.nb_submissions - self.nb_indigents
         self.save()
+        logger.debug("ONA connections: {}".format(get_session_stats()))
+        return nb_scans
 
     def reset_scan_form_data(self, delete_submissions=False):
         # remove indigent
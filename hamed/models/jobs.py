@@ -0,0 +1,327 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim: ai ts=4 sts=4 et sw=4 nu
+
+import os
+import socket
+import logging
+from collections import OrderedDict
+
+from django.db import models
+from django.urls import reverse
+from django.utils import timezone
+from jsonfield.fields import JSONField
+
+from hamed.models.collects import Collect
+
+logger = logging.getLogger(__name__)
+
+
+class Job(models.Model):
+    """a collect state transition (TaskCollection) run by the `run_jobs` worker"""
+
+    START = "start"
+    END = "end"
+    FINALIZE = "finalize"
+    REOPEN = "reopen"
+    SYNC = "sync"
+
+    KINDS = OrderedDict(
+        [
+            (START, "Création de la collecte"),
+            (END, "Cloture de la collecte"),
+            (FINALIZE, "Finalisation de la collecte"),
+            (REOPEN, "Ré-ouverture de la collecte"),
+            (SYNC, "Synchronisation de la collecte"),
+        ]
+    )
+
+    # verb used in failure messages, success message
+    MESSAGES = {
+        START: ("créer", "La collecte «{}» a bien été créée."),
+        END: ("terminer", "Collecte «{}» terminée."),
+        FINALIZE: ("finaliser", "Collecte «{}» finalisée."),
+        REOPEN: ("ré-ouvrir", "Collecte «{}» ré-ouverte."),
+        SYNC: ("synchroniser", "Collecte «{}» synchronisée."),
+    }
+
+    PENDING = "pending"
+    RUNNING = "running"
+    SUCCESS = "success"
+    FAILED = "failed"
+
+    STATUSES = OrderedDict(
+        [
+            (PENDING, "En attente"),
+            (RUNNING, "En cours"),
+            (SUCCESS, "Terminé"),
+            (FAILED, "Échec"),
+        ]
+    )
+
+    UNFINISHED_STATUSES = (PENDING, RUNNING)
+
+    class Meta:
+        ordering = ["-created_on"]
+
+    kind = models.CharField(max_length=50, choices=KINDS.items())
+    status = models.CharField(max_length=50, choices=STATUSES.items(), default=PENDING)
+    collect = models.ForeignKey(
+        Collect,
+        blank=True,
+        null=True,
+        related_name="jobs",
+        on_delete=models.SET_NULL,
+    )
+    # TaskCollection inputs which are not the collect (new collect form data)
+    payload = JSONField(default=dict, blank=True)
+
+    created_on = models.DateTimeField(auto_now_add=True)
+    started_on = models.DateTimeField(blank=True, null=True)
+    ended_on = models.DateTimeField(blank=True, null=True)
+
+    # ratio of tasks done and name of the current one
+    progress = models.FloatField(default=0)
+    step = models.CharField(max_length=100, blank=True, null=True)
+    message = models.TextField(blank=True, null=True)
+    # host:pid of the run_jobs worker which claimed it
+    worker = models.CharField(max_length=100, blank=True, null=True)
+
+    def __str__(self):
+        return "Job #{id} {kind} ({status})".format(
+            id=self.id, kind=self.kind, status=self.status
+        )
+
+    @classmethod
+    def get_or_none(cls, jid):
+        try:
+            return cls.objects.get(id=jid)
+        except cls.DoesNotExist:
+            return None
+
+    @classmethod
+    def enqueue(cls, kind, collect=None, payload={}):
+        """new pending Job or the unfinished one already queued for collect
+
+        syncs are background jobs: pending ones are superseded by any other
+        job and a running one only delays it (see claim_next)."""
+        assert kind in cls.KINDS.keys()
+        if collect is not None:
+            jobs = collect.jobs.filter(status__in=cls.UNFINISHED_STATUSES)
+            if kind != cls.SYNC:
+                jobs.filter(kind=cls.SYNC, status=cls.PENDING).delete()
+                jobs = jobs.exclude(kind=cls.SYNC)
+            job = jobs.first()
+            if job is not None:
+                return job
+        return cls.objects.create(kind=kind, collect=collect, payload=payload)
+
+    @staticmethod
+    def get_worker_id():
+        return "{host}:{pid}".format(host=socket.gethostname(), pid=os.getpid())
+
+    @staticmethod
+    def is_worker_alive(worker):
+        """whether worker (host:pid) is a running process other than this one
+
+        workers of other hosts are considered alive."""
+        if not worker:
+            return False
+        host, pid = worker.rsplit(":", 1)
+        if host != socket.gethostname():
+            return True
+        # pid of a worker from before a reboot can be ours
+        if int(pid) == os.getpid():
+            return False
+        try:
+            os.kill(int(pid), 0)
+        except ProcessLookupError:
+            return False
+        except PermissionError:
+            pass
+        return True
+
+    @classmethod
+    def claim_next(cls):
+        """oldest pending Job, marked as running (safe with several workers)
+
+        jobs of a collect are run one at a time."""
+        for job in cls.objects.filter(status=cls.PENDING).order_by("created_on"):
+            running = cls.objects.filter(status=cls.RUNNING, collect__isnull=False)
+            if job.collect_id and running.filter(collect_id=job.collect_id).exists():
+                continue
+            if cls.objects.filter(id=job.id, status=cls.PENDING).update(
+                status=cls.RUNNING,
+                started_on=timezone.now(),
+                worker=cls.get_worker_id(),
+            ):
+                # another worker claimed a job of this collect meanwhile
+                if (
+                    job.collect_id
+                    and running.filter(collect_id=job.collect_id)
+                    .exclude(id=job.id)
+                    .exists()
+                ):
+                    cls.objects.filter(id=job.id).update(
+                        status=cls.PENDING, started_on=None, worker=None
+                    )
+                    continue
+                job.refresh_from_db()
+                return job
+        return None
+
+    @classmethod
+    def fail_interrupted(cls):
+        """mark jobs left running by a stopped worker as failed
+
+        jobs of workers still running (several can run) are left alone."""
+        interrupted = [
+            job.id
+            for job in cls.objects.filter(status=cls.RUNNING)
+            if not cls.is_worker_alive(job.worker)
+        ]
+        return cls.objects.filter(id__in=interrupted, status=cls.RUNNING).update(
+            status=cls.FAILED,
+            ended_on=timezone.now(),
+            message="Opération interrompue. Contactez le support.",
+        )
+
+    @property
+    def verbose_kind(self):
+        return self.KINDS.get(self.kind)
+
+    @property
+    def verbose_status(self):
+        return self.STATUSES.get(self.status)
+
+    @property
+    def finished(self):
+        return self.status not in self.UNFINISHED_STATUSES
+
+    def get_task_collection_cls(self):
+        from hamed.steps.start_collect import StartCollectTaskCollection
+        from hamed.steps.end_collect import EndCollectTaskCollection
+        from hamed.steps.finalize_collect import FinalizeCollectTaskCollection
+        from hamed.steps.reopen_collect import ReopenCollectTaskCollection
+        from hamed.steps.sync_collect import SyncCollectTaskCollection
+
+        return {
+            self.START: StartCollectTaskCollection,
+            self.END: EndCollectTaskCollection,
+            self.FINALIZE: FinalizeCollectTaskCollection,
+            self.REOPEN: ReopenCollectTaskCollection,
+            self.SYNC: SyncCollectTaskCollection,
+        }.get(self.kind)
+
+    def get_inputs(self):
+        """TaskCollection kwargs (inputs and checkpoint store)"""
+        if self.kind == self.START:
+            from hamed.forms import NewCollectForm
+
+            form = NewCollectForm(self.payload)
+            if not form.is_valid():
+                raise ValueError("Invalid collect form: {}".format(form.errors))
+            return {"form": form}
+        return {
+            "collect": self.collect,
+            "checkpoint": self.collect.get_checkpoint_store(
+                self.get_task_collection_cls()
+            ),
+        }
+
+    def update_progress(self, collection, nb_done, task_name):
+        self.progress = nb_done / collection.nb_tasks if collection.nb_tasks else 1
+        self.step = task_name
+        self.save(update_fields=["progress", "step"])
+
+    def record_task_runs(self, collection):
+        from hamed.models.task_runs import TaskRun
+
+        # start job's collect is removed if it failed
+        collect = collection.inputs.get("collect") or self.collect
+        if collect is not None and collect.id is None:
+            collect = None
+        try:
+            TaskRun.record(collection, collect=collect, job=self)
+        except Exception as exp:
+            logger.error("Unable to record tasks metrics of {}".format(self))
+            logger.exception(exp)
+
+    def run(self):
+        """process the TaskCollection and record its outcome"""
+        logger.info("Running {}".format(self))
+        # pick up Settings edited (in web process) since the last job
+        from hamed.models.settings import Settings
+
+        Settings.invalidate_cache()
+        verb, success_message = self.MESSAGES.get(self.kind)
+        try:
+            tc = self.get_task_collection_cls()(
+                progress_callback=self.update_progress, **self.get_inputs()
+            )
+            tc.process()
+            self.record_task_runs(tc)
+        except Exception as exp:
+            logger.exception(exp)
+            self.status = self.FAILED
+            self.message = "Impossible de {verb} la collecte. (exp: {exp})".format(
+                verb=verb, exp=exp
+            )
+        else:
+            if tc.successful:
+                # start job creates the collect
+                if self.collect is None:
+                    self.collect = tc.inputs.get("collect")
+                self.status = self.SUCCESS
+                self.message = success_message.format(self.collect)
+            elif tc.suspended:
+                self.status = self.FAILED
+                self.message = (
+                    "Impossible de {verb} la collecte. "
+                    "Les étapes terminées sont conservées : relancez "
+                    "l'opération pour reprendre où elle s'est arrêtée. "
+                    "(exp: {exp})\n\n{tb}".format(
+                        verb=verb, exp=tc.exception, tb=tc.traceback
+                    )
+                )
+            elif not tc.clean_state:
+                self.status = self.FAILED
+                self.message = (
+                    "Impossible de {verb} la collecte. "
+                    "Erreur lors de la tentative "
+                    "de retour à l'état précédent (exp: {exp})\n\n{tb}".format(
+                        verb=verb, exp=tc.exception, tb=tc.traceback
+                    )
+                )
+            else:
+                self.status = self.FAILED
+                self.message = (
+                    "Impossible de {verb} la collecte. "
+                    "Collecte retournée à l'état précédent. "
+                    "(exp: {exp})\n\n{tb}".format(
+                        verb=verb, exp=tc.exception, tb=tc.traceback
+                    )
+                )
+
+        self.ended_on = timezone.now()
+        self.save()
+        logger.info("Finished {}".format(self))
+
+    def get_redirect_url(self):
+        """where to send user once job is over"""
+        if self.collect is None or self.collect.id is None:
+            return reverse("home")
+        return reverse("collect", kwargs={"collect_id": self.collect.id})
+
+    def to_dict(self):
+        return {
+            "id": self.id,
+            "kind": self.kind,
+            "status": self.status,
+            "verbose_status": self.verbose_status,
+            "finished": self.finished,
+            "progress": self.progress,
+            "step": self.step,
+            "message": self.message,
+            "redirect": self.get_redirect_url(),
+        }
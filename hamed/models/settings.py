@@ -2,12 +2,20 @@
 # -*- coding: utf-8 -*-
 # vim: ai ts=4 sts=4 et sw=4 nu
 
+import time
 import logging
 
+from django.conf import settings
 from django.db import models
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
 
 logger = logging.getLogger(__name__)
 
+# {key: Settings} for the whole table, loaded on first lookup
+_cache = None
+_cache_loaded_on = 0
+
 
 class Settings(models.Model):
     class Meta:
@@ -26,19 +34,41 @@ class Settings(models.Model):
     key = models.SlugField(primary_key=True)
     value = models.CharField(max_length=500)
 
+    @classmethod
+    def get_all(cls):
+        """all Settings by key, cached in process memory
+
+        cache is dropped on save/delete of any Settings in this process and
+        expires after SETTINGS_CACHE_TTL (changes from other processes)"""
+        global _cache, _cache_loaded_on
+        # local reference: cache may be invalidated by another thread
+        cache = _cache
+        if (
+            cache is None
+            or time.monotonic() - _cache_loaded_on > settings.SETTINGS_CACHE_TTL
+        ):
+            cache = {setting.key: setting for setting in cls.objects.all()}
+            _cache = cache
+            _cache_loaded_on = time.monotonic()
+        return cache
+
+    @classmethod
+    def invalidate_cache(cls):
+        global _cache
+        _cache = None
+
+    @classmethod
+    def as_dict(cls):
+        return {key: setting.value for key, setting in cls.get_all().items()}
+
     @classmethod
     def get_or_none(cls, key):
-        try:
-            return cls.objects.get(key=key)
-        except cls.DoesNotExist:
-            return None
+        return cls.get_all().get(key)
 
     @classmethod
     def get_value_or_none(cls, key):
-        try:
-            return cls.objects.get(key=key).value
-        except cls.DoesNotExist:
-            return None
+        setting = cls.get_or_none(key)
+        return setting.value if setting is not None else None
 
     def __str__(self):
         return self.key
@@ -70,3 +100,9 @@ class Settings(models.Model):
     @classmethod
     def upload_token(cls):
         return cls.get_value_or_none(cls.UPLOAD_TOKEN)
+
+
+@receiver(post_save, sender=Settings)
+@receiver(post_delete, sender=Settings)
+def invalidate_settings_cache(sender, **kwargs):
+    Settings.invalidate_cache()
@@ -5,20 +5,59 @@
 import logging
 import os
 from collections import OrderedDict
+from functools import lru_cache
 import io
 import qrcode
 
 from django.db import models
+from django.conf import settings
 from django.utils import timezone
 from jsonfield.fields import JSONField
 
-from hamed.identifiers import full_random_id
-from hamed.utils import get_attachment, PERSONAL_FILES, slugify_for_disk
+from hamed.constants import PERSONAL_FILES
+from hamed.identifiers import IdentifierAllocator
+from hamed.utils import get_attachment, slugify_for_disk
 from hamed.ona import delete_submission
 
 logger = logging.getLogger(__name__)
 
 
+QRCODE_FNAME = ".qrcode.png"
+
+
+def render_qrcode_png(identifier):
+    qr = qrcode.QRCode(
+        version=1,
+        error_correction=qrcode.constants.ERROR_CORRECT_H,
+        box_size=10,
+        border=4,
+    )
+
+    qr.add_data(identifier)
+    qr.make(fit=True)
+    im = qr.make_image()
+    output = io.BytesIO()
+    im.save(output, format="PNG")
+    return output.getvalue()
+
+
+@lru_cache(maxsize=settings.QRCODE_CACHE_SIZE)
+def get_qrcode_png(identifier, cache_fpath=None):
+    """QR code PNG bytes for identifier, kept in an in-memory LRU
+
+    on a miss, the copy persisted at cache_fpath is used if present,
+    otherwise the code is rendered (and persisted if folder exists)"""
+    if cache_fpath and os.path.exists(cache_fpath):
+        with open(cache_fpath, "rb") as f:
+            return f.read()
+
+    png = render_qrcode_png(identifier)
+    if cache_fpath and os.path.isdir(os.path.dirname(cache_fpath)):
+        with open(cache_fpath, "wb") as f:
+            f.write(png)
+    return png
+
+
 class IndigentManager(models.Manager):
     def get_queryset(self):
         return super(IndigentManager, self).get_queryset().filter(is_indigent=True)
@@ -37,6 +76,7 @@ class Target(models.Model):
     FEMALE = "female"
     GENDERS = OrderedDict([(MALE, "Masculin"), (FEMALE, "Feminin")])
     SEXES = OrderedDict([(MALE, "Homme"), (FEMALE, "Femme")])
+    DATASET_FIELDS = ("form_dataset", "scan_form_dataset")
 
     identifier = models.CharField(max_length=10, primary_key=True)
     collect = models.ForeignKey("Collect", related_name="targets")
@@ -74,35 +114,81 @@ class Target(models.Model):
     def verbose_sex(self):
         return self.SEXES.get(self.gender)
 
+    def __setattr__(self, name, value):
+        # merged dataset and attachments are derived from the JSON fields
+        if name in self.DATASET_FIELDS:
+            self.invalidate_dataset_cache()
+        super(Target, self).__setattr__(name, value)
+
+    def invalidate_dataset_cache(self):
+        """to be called after modifying a JSON field in place"""
+        for key in ("_dataset_cache", "_attachments_index", "_attachments_cache"):
+            self.__dict__.pop(key, None)
+
     @property
     def dataset(self):
-        dataset = self.form_dataset.copy()
-        for key, value in self.scan_form_dataset.items():
-            if key not in dataset:
-                dataset.update({key: value})
-            elif key == "_attachments":
-                dataset[key] += value
-            else:
-                dataset.update({"_scan:{}".format(key): value})
-        return dataset
+        if self.__dict__.get("_dataset_cache") is None:
+            dataset = self.form_dataset.copy()
+            for key, value in self.scan_form_dataset.items():
+                if key not in dataset:
+                    dataset.update({key: value})
+                elif key == "_attachments":
+                    # new list so form_dataset's one is left untouched
+                    dataset[key] = dataset[key] + value
+                else:
+                    dataset.update({"_scan:{}".format(key): value})
+            self._dataset_cache = dataset
+        return self._dataset_cache
+
+    def find_attachment(self, question_value):
+        """attachment dict for a question value (filename), O(1) lookup"""
+        if question_value is None:
+            return None
+
+        if self.__dict__.get("_attachments_index") is None:
+            index = {}
+            for attachment in self.dataset.get("_attachments", []):
+                fname = os.path.basename(attachment.get("filename", ""))
+                index.setdefault(fname, attachment)
+            self._attachments_index = index
+
+        attachment = self._attachments_index.get(question_value)
+        if attachment is None:
+            # question value might not be a whole basename
+            return get_attachment(self.dataset, question_value)
+        return attachment
 
     def __str__(self):
         return "{ident}.{name}".format(ident=self.identifier, name=self.name())
 
     @classmethod
     def get_unused_ident(cls):
-        nb_targets = cls.objects.count()
-        attempts = 0
-        while attempts <= nb_targets + 10:
-            attempts += 1
-            ident = full_random_id()
-            if cls.objects.filter(identifier=ident).count():
-                continue
-            return ident
-        raise Exception("Unable to compute a free identifier for Target.")
+        return cls.get_unused_idents(1)[0]
+
+    @classmethod
+    def get_identifier_allocator(cls):
+        """allocator aware of all identifiers in use (single query)"""
+        return IdentifierAllocator(
+            used=cls.objects.values_list("identifier", flat=True)
+        )
+
+    @classmethod
+    def get_unused_idents(cls, nb):
+        """nb distinct free identifiers"""
+        allocator = cls.get_identifier_allocator()
+        idents = allocator.allocate(nb)
+        logger.debug("Identifiers: {}".format(allocator.stats()))
+        return idents
 
     @classmethod
     def create_from_submission(cls, collect, submission):
+        target = cls.build_from_submission(collect, submission)
+        target.save(force_insert=True)
+        return target
+
+    @classmethod
+    def build_from_submission(cls, collect, submission, identifier=None):
+        """unsaved Target for a submission (see Collect.process_form_data)"""
         sex = submission.get("enquete/sexe")
         birth_type = submission.get("enquete/type-naissance")
         yob = submission.get("enquete/annee-naissance", "")
@@ -112,7 +198,7 @@ class Target(models.Model):
             yob = int(dob.split("-")[0])
         age = this_year - int(yob)
         payload = {
-            "identifier": cls.get_unused_ident(),
+            "identifier": identifier or cls.get_unused_ident(),
             "collect": collect,
             "first_name": submission.get("enquete/prenoms"),
             "last_name": submission.get("enquete/nom"),
@@ -126,7 +212,7 @@ class Target(models.Model):
             or submission.get("localisation-enquete/lieu_commune"),
             "form_dataset": submission,
         }
-        return cls.objects.create(**payload)
+        return cls(**payload)
 
     def update_with_scan_submission(self, submission):
         self.scan_form_dataset = submission
@@ -140,23 +226,19 @@ class Target(models.Model):
         except cls.DoesNotExist:
             return None
 
-    def get_qrcode(self):
-        qr = qrcode.QRCode(
-            version=1,
-            error_correction=qrcode.constants.ERROR_CORRECT_H,
-            box_size=10,
-            border=4,
-        )
+    def get_qrcode_path(self):
+        return os.path.join(self.get_folder_path(), QRCODE_FNAME)
 
-        qr.add_data(self.identifier)
-        qr.make(fit=True)
-        im = qr.make_image()
-        output = io.BytesIO()
-        im.save(output, format="PNG")
-        output.seek(0)
-        return output
+    def get_qrcode(self):
+        cache_fpath = self.get_qrcode_path() if settings.QRCODE_DISK_CACHE else None
+        return io.BytesIO(get_qrcode_png(self.identifier, cache_fpath))
 
     def attachments(self):
+        if self.__dict__.get("_attachments_cache") is None:
+            self._attachments_cache = self.build_attachments()
+        return self._attachments_cache
+
+    def build_attachments(self):
 
         labels = {
             "acte-naissance/image_acte_naissance": {
@@ -221,7 +303,7 @@ class Target(models.Model):
 
         # retrieve each expected image, add label and export fname
         for key, label in labels.items():
-            attachment = get_attachment(self.dataset, self.dataset.get(key))
+            attachment = self.find_attachment(self.dataset.get(key))
             if attachment is None:
                 continue
             attachment["labels"] = label
@@ -238,7 +320,7 @@ class Target(models.Model):
         for index, spouse in enumerate(self.dataset.get("epouses", [])):
             spouse_data = {}
             for key, label in spouses_labels.items():
-                attachment = get_attachment(self.dataset, spouse.get(key))
+                attachment = self.find_attachment(spouse.get(key))
                 if attachment is None:
                     continue
                 attachment["labels"] = label
@@ -256,7 +338,7 @@ class Target(models.Model):
         for index, children in enumerate(self.dataset.get("enfants", [])):
             children_data = {}
             for key, label in children_labels.items():
-                attachment = get_attachment(self.dataset, children.get(key))
+                attachment = self.find_attachment(children.get(key))
                 if attachment is None:
                     continue
                 attachment["labels"] = label
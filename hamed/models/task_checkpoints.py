@@ -0,0 +1,77 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim: ai ts=4 sts=4 et sw=4 nu
+
+import pickle
+import logging
+
+from django.db import models
+from jsonfield.fields import JSONField
+
+from hamed.models.collects import Collect
+
+logger = logging.getLogger(__name__)
+
+
+class TaskCheckpoint(models.Model):
+    """completed tasks of a suspended TaskCollection run, to resume from"""
+
+    class Meta:
+        unique_together = [("collect", "collection")]
+        ordering = ["-updated_on"]
+
+    collect = models.ForeignKey(
+        Collect, related_name="checkpoints", on_delete=models.CASCADE
+    )
+    collection = models.CharField(max_length=100)
+    # names of the completed tasks, in order
+    completed = JSONField(default=list, blank=True)
+    # pickled {key: value} outputs of the completed tasks
+    outputs = models.BinaryField()
+    updated_on = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return "{collection} on {collect}".format(
+            collection=self.collection, collect=self.collect
+        )
+
+    @property
+    def last_completed(self):
+        return self.completed[-1] if self.completed else None
+
+    def get_outputs(self):
+        return pickle.loads(bytes(self.outputs))
+
+
+class CheckpointStore(object):
+    """TaskCollection checkpoint store persisting to TaskCheckpoint"""
+
+    def __init__(self, collect, collection):
+        self.collect = collect
+        self.collection = collection
+
+    def get_checkpoint(self):
+        return TaskCheckpoint.objects.filter(
+            collect=self.collect, collection=self.collection
+        ).first()
+
+    def load(self):
+        checkpoint = self.get_checkpoint()
+        if checkpoint is None:
+            return None
+        return {"completed": checkpoint.completed, "outputs": checkpoint.get_outputs()}
+
+    def save(self, completed, outputs):
+        TaskCheckpoint.objects.update_or_create(
+            collect=self.collect,
+            collection=self.collection,
+            defaults={
+                "completed": completed,
+                "outputs": pickle.dumps(outputs, protocol=pickle.HIGHEST_PROTOCOL),
+            },
+        )
+
+    def discard(self):
+        TaskCheckpoint.objects.filter(
+            collect=self.collect, collection=self.collection
+        ).delete()
@@ -0,0 +1,85 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim: ai ts=4 sts=4 et sw=4 nu
+
+import logging
+import datetime
+
+from django.db import models
+from django.utils import timezone
+from jsonfield.fields import JSONField
+
+from hamed.models.collects import Collect
+from hamed.models.jobs import Job
+
+logger = logging.getLogger(__name__)
+
+
+class TaskRun(models.Model):
+    """metrics of a Task processed within a TaskCollection run (a Job)"""
+
+    class Meta:
+        ordering = ["job", "index"]
+
+    job = models.ForeignKey(
+        Job, blank=True, null=True, related_name="task_runs", on_delete=models.CASCADE
+    )
+    collect = models.ForeignKey(
+        Collect,
+        blank=True,
+        null=True,
+        related_name="task_runs",
+        on_delete=models.SET_NULL,
+    )
+    collection = models.CharField(max_length=100)
+    task = models.CharField(max_length=100)
+    index = models.IntegerField()
+    status = models.CharField(max_length=50)
+
+    started_on = models.DateTimeField(blank=True, null=True)
+    # seconds
+    wall_time = models.FloatField(blank=True, null=True)
+    cpu_time = models.FloatField(blank=True, null=True)
+    # bytes, high-water mark of the process at the end of task
+    peak_memory = models.BigIntegerField(blank=True, null=True)
+    # {kind: nb} of items handled (submissions, attachments, pdfs)
+    counts = JSONField(default=dict, blank=True)
+
+    def __str__(self):
+        return "{collection}.{task} ({wall:.2f}s)".format(
+            collection=self.collection, task=self.task, wall=self.wall_time or 0
+        )
+
+    @classmethod
+    def record(cls, collection, collect=None, job=None):
+        """save metrics of all tasks processed by a TaskCollection"""
+        runs = []
+        for index, task in enumerate(collection.processed):
+            started_on = task.metrics.started_on
+            runs.append(
+                cls(
+                    job=job,
+                    collect=collect,
+                    collection=collection.name,
+                    task=task.name,
+                    index=index,
+                    status=task.status,
+                    started_on=datetime.datetime.fromtimestamp(
+                        started_on, tz=timezone.utc
+                    )
+                    if started_on
+                    else None,
+                    wall_time=task.metrics.wall_time,
+                    cpu_time=task.metrics.cpu_time,
+                    peak_memory=task.metrics.peak_memory,
+                    counts=task.metrics.counts,
+                )
+            )
+        return cls.objects.bulk_create(runs)
+
+    @property
+    def cpu_ratio(self):
+        """CPU time over wall time (> 1 when using several cores)"""
+        if not self.wall_time:
+            return None
+        return self.cpu_time / self.wall_time
@@ -3,9 +3,17 @@
 # vim: ai ts=4 sts=4 et sw=4 nu
 
 import io
+import os
+import json
+import codecs
 import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
 
 import requests
+from requests.adapters import HTTPAdapter
+from requests.packages.urllib3.util.retry import Retry
+from django.conf import settings
 
 from hamed.models.settings import Settings
 from hamed.exceptions import ONAAPIError
@@ -17,11 +25,87 @@ XLSX_MIME = (
     ".sheet; charset=binary"
 )
 CSV_MIME = "text/plain; charset=utf-8"
+# attachment keys which may already hold the file size in submissions' JSON
+ATTACHMENT_SIZE_KEYS = ("filesize", "bytes", "media_file_size", "file_size", "size")
 DATAENTRY_ROLE = "dataentry-only"
 READONLY_ROLE = "readonly-no-download"
 
 logger = logging.getLogger(__name__)
 
+_adapter = None
+_session = None
+_session_lock = threading.Lock()
+_session_pid = os.getpid()
+
+
+def check_session_owner():
+    """drop pool inherited from a parent process (sockets can't be shared)"""
+    global _adapter, _session, _session_lock, _session_pid
+    if _session_pid != os.getpid():
+        _adapter = None
+        _session = None
+        _session_lock = threading.Lock()
+        _session_pid = os.getpid()
+
+
+def get_adapter():
+    """pooled, retrying transport adapter shared by all ONA sessions"""
+    global _adapter
+    check_session_owner()
+    with _session_lock:
+        if _adapter is None:
+            retries = Retry(
+                total=settings.ONA_HTTP_MAX_RETRIES,
+                backoff_factor=settings.ONA_HTTP_BACKOFF_FACTOR,
+                status_forcelist=(502, 503, 504),
+            )
+            _adapter = HTTPAdapter(
+                pool_connections=settings.ONA_HTTP_POOL_CONNECTIONS,
+                pool_maxsize=settings.ONA_HTTP_POOL_MAXSIZE,
+                pool_block=True,
+                max_retries=retries,
+            )
+        return _adapter
+
+
+def new_session():
+    """requests Session with its own cookie jar but the shared pool"""
+    session = requests.Session()
+    adapter = get_adapter()
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+
+def get_session():
+    """keep-alive Session used for every (token-authenticated) ONA call"""
+    global _session
+    check_session_owner()
+    if _session is None:
+        session = new_session()
+        with _session_lock:
+            if _session is None:
+                _session = session
+    return _session
+
+
+def get_session_stats():
+    """connections opened vs requests sent through the shared pool"""
+    nb_connections = 0
+    nb_requests = 0
+    pools = get_adapter().poolmanager.pools
+    for key in pools.keys():
+        pool = pools.get(key)
+        if pool is None:
+            continue
+        nb_connections += pool.num_connections
+        nb_requests += pool.num_requests
+    return {
+        "opened": nb_connections,
+        "reused": max(nb_requests - nb_connections, 0),
+        "requests": nb_requests,
+    }
+
 
 def get_base_url():
     return Settings.get_or_none(Settings.ONA_SERVER).value
@@ -161,18 +245,12 @@ def request(
     silent_failure=False,
 ):
     url = get_url(path)
-    methods = {
-        "POST": requests.post,
-        "DELETE": requests.delete,
-        "GET": requests.get,
-        "OPTIONS": requests.options,
-        "HEAD": requests.head,
-        "PUT": requests.put,
-        "PATCH": requests.patch,
-    }
-    func = methods.get(method, requests.get)
+    methods = ("POST", "DELETE", "GET", "OPTIONS", "HEAD", "PUT", "PATCH")
+    if method not in methods:
+        method = "GET"
     headers.update(get_auth_header())
-    req = func(
+    req = get_session().request(
+        method=method,
         url=url,
         params=params,
         data=payload,
@@ -223,7 +301,7 @@ def get_form_detail(form_pk):
 def toggle_downloadable_ona_form(form_pk, downloadable):
     # TODO: move to patch method
     url = get_url(get_api_path("/forms/{pk}".format(pk=form_pk)))
-    req = requests.patch(
+    req = get_session().patch(
         url=url, headers=get_auth_header(), data={"downloadable": downloadable}
     )
     try:
@@ -255,10 +333,138 @@ def get_form_data(form_pk):
     return get(get_api_path("/data/{pk}".format(pk=form_pk)))
 
 
+def iter_json_array(chunks):
+    """yield items of a JSON array as its text chunks arrive"""
+    decoder = json.JSONDecoder()
+    buffer = ""
+    started = False
+    for chunk in chunks:
+        buffer += chunk
+        while True:
+            buffer = buffer.lstrip()
+            if not buffer:
+                break
+            if not started:
+                if buffer[0] != "[":
+                    raise ValueError("JSON payload is not an array")
+                buffer = buffer[1:]
+                started = True
+                continue
+            if buffer[0] == ",":
+                buffer = buffer[1:]
+                continue
+            if buffer[0] == "]":
+                return
+            try:
+                item, end = decoder.raw_decode(buffer)
+            except ValueError:
+                # incomplete item, wait for next chunk
+                break
+            # an item is always followed by `,` or `]`: a number (`12` of
+            # `123`) might be cut by the chunk boundary
+            if end == len(buffer):
+                break
+            yield item
+            buffer = buffer[end:]
+    raise ValueError("Truncated JSON array")
+
+
+def iter_form_data(form_pk, page_size=None, params={}):
+    """yield form's submissions one by one, downloaded page per page
+
+    each page is streamed and decoded incrementally so memory usage
+    is bounded by a single submission, not the whole dataset"""
+    if page_size is None:
+        page_size = settings.ONA_DATA_PAGE_SIZE
+    url = get_url(get_api_path("/data/{pk}".format(pk=form_pk)))
+    page = 1
+    while True:
+        query = dict(params)
+        query.update({"page": page, "page_size": page_size})
+        req = get_session().get(
+            url, params=query, headers=get_auth_header(), stream=True, timeout=60
+        )
+        # ONA answers with a 404 once past the last page
+        if req.status_code == 404 and page > 1:
+            req.close()
+            return
+        if req.status_code != 200:
+            exp = ONAAPIError.from_request(req)
+            logger.error("ONA Request Error. {exp}".format(exp=exp))
+            raise exp
+
+        decoder = codecs.getincrementaldecoder(req.encoding or "utf-8")()
+        chunks = (
+            decoder.decode(chunk) for chunk in req.iter_content(chunk_size=65536)
+        )
+        nb_submissions = 0
+        try:
+            for submission in iter_json_array(chunks):
+                nb_submissions += 1
+                yield submission
+        finally:
+            req.close()
+
+        if nb_submissions < page_size:
+            return
+        page += 1
+
+
+class LazyFormData(object):
+    """re-iterable view on a form's submissions, downloaded on iteration"""
+
+    def __init__(self, form_pk, page_size=None, params={}):
+        self.form_pk = form_pk
+        self.page_size = page_size
+        self.params = params
+
+    def __iter__(self):
+        return iter_form_data(self.form_pk, self.page_size, self.params)
+
+
+def get_media_url(filename):
+    return get_url("{media}/{fname}".format(media=ONA_MEDIA, fname=filename))
+
+
 def get_media_size(filename):
-    url = get_url("{media}/{fname}".format(media=ONA_MEDIA, fname=filename))
-    resp = requests.head(url)
-    return int(resp.headers["Content-Length"])
+    return head_media_size(get_media_url(filename))
+
+
+def head_media_size(url):
+    """size advertised by the media server, None if not advertised"""
+    req = get_session().head(url, allow_redirects=True, timeout=60)
+    if req.status_code != 200:
+        exp = ONAAPIError.from_request(req)
+        logger.error("ONA Request Error. {exp}".format(exp=exp))
+        raise exp
+    try:
+        return int(req.headers["Content-Length"])
+    except (KeyError, ValueError):
+        return None
+
+
+def get_attachment_size(attachment):
+    """size advertised in the attachment metadata, None if not present"""
+    for key in ATTACHMENT_SIZE_KEYS:
+        try:
+            return int(attachment[key])
+        except (KeyError, TypeError, ValueError):
+            continue
+    return None
+
+
+def get_media_sizes(filenames, concurrency=None):
+    """{filename: size} for all filenames, HEAD requests ran concurrently
+
+    URLs are built upfront so that worker threads don't hit the database"""
+    if concurrency is None:
+        concurrency = settings.ONA_MEDIA_PROBE_CONCURRENCY
+    urls = {fname: get_media_url(fname) for fname in set(filenames)}
+    if not urls:
+        return {}
+    with ThreadPoolExecutor(max_workers=max(1, concurrency)) as executor:
+        sizes = executor.map(head_media_size, urls.values())
+        return dict(zip(urls.keys(), sizes))
 
 
 def upload_csv_media(form_pk, media_csv, media_fname):
@@ -271,7 +477,7 @@ def upload_csv_media(form_pk, media_csv, media_fname):
 
 
 def delete_media(collect, media_id):
-    session = requests.Session()
+    session = new_session()
 
     # first authenticate with token
     resp = session.get(get_url("/token-auth"), headers=get_auth_header())
@@ -289,7 +495,7 @@ def delete_media(collect, media_id):
 
 def download_media(path):
     url = get_url(path)
-    req = requests.get(url)
+    req = get_session().get(url)
 
     try:
         assert req.status_code == 200
@@ -302,6 +508,44 @@ def download_media(path):
         logger.exception(exp)
 
 
+def download_media_to(url, fpath, expected_size=None):
+    """stream media at url to fpath, return number of bytes downloaded
+
+    data goes to a hidden `.part` file first, renamed once complete. A
+    `.part` left by an interrupted download is resumed (HTTP Range)."""
+    folder, fname = os.path.split(fpath)
+    part_fpath = os.path.join(folder, ".{}.part".format(fname))
+    offset = os.path.getsize(part_fpath) if os.path.exists(part_fpath) else 0
+
+    if offset and offset == expected_size:
+        os.rename(part_fpath, fpath)
+        return 0
+
+    headers = {"Range": "bytes={}-".format(offset)} if offset else {}
+    req = get_session().get(url, headers=headers, stream=True, timeout=60)
+    try:
+        if req.status_code == 206:
+            mode = "ab"
+        elif req.status_code == 200:
+            # range not honored (or not requested): restart from scratch
+            mode = "wb"
+        else:
+            exp = ONAAPIError.from_request(req)
+            logger.error("ONA Request Error. {exp}".format(exp=exp))
+            raise exp
+
+        nb_bytes = 0
+        with open(part_fpath, mode) as f:
+            for chunk in req.iter_content(chunk_size=settings.MEDIAS_CHUNK_SIZE):
+                f.write(chunk)
+                nb_bytes += len(chunk)
+    finally:
+        req.close()
+
+    os.rename(part_fpath, fpath)
+    return nb_bytes
+
+
 def get_media_id(form_pk, media_fname):
     resp = get(get_api_path("/metadata.json"), params={"xform": form_pk})
     filtered = [
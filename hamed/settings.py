@@ -166,6 +166,62 @@ STATICFILES_DIRS = []
 
 COLLECT_DOCUMENTS_FOLDER = os.path.join(BASE_DIR, "Collectes-RAMED")
 
+# PDF documents generation: worker processes (None: one per core, 1: serial)
+# and number of targets handed to a worker at once
+DOCUMENTS_WORKERS = None
+DOCUMENTS_CHUNK_SIZE = 10
+# bump to force re-rendering of all documents (PDF modules changes do it too)
+DOCUMENTS_TEMPLATE_VERSION = 1
+
+# medias export: concurrent downloads and streaming chunk size (bytes)
+MEDIAS_EXPORT_WORKERS = 4
+MEDIAS_CHUNK_SIZE = 256 * 1024
+
+# local copies of medias served by the attachment proxy (LRU, size in bytes)
+MEDIA_CACHE_FOLDER = os.path.join(BASE_DIR, "media-cache")
+MEDIA_CACHE_MAX_SIZE = 512 * 1024 * 1024
+
+# QR codes: number of images kept in memory and whether a copy is persisted
+# (hidden file) in each target's folder, reused across regenerations
+QRCODE_CACHE_SIZE = 4096
+QRCODE_DISK_CACHE = True
+
+# USB exports: concurrent writers and size of their (page aligned) buffers
+USB_COPY_WORKERS = 4
+USB_COPY_BUFFER_SIZE = 1024 * 1024
+# max number of progress updates sent to the browser per second
+USB_PROGRESS_RATE = 4
+# archive export mode: compression (stored or deflate) and max size of each
+# archive (bytes, must stay under FAT32's 4GB file limit)
+USB_ARCHIVE_COMPRESSION = "stored"
+USB_ARCHIVE_MAX_SIZE = 1024 * 1024 * 1024
+# checksum computed while copying (listed in the stick's manifest) and ratio
+# of files re-read from the stick by the verify pass (mismatching sizes are
+# always re-read)
+USB_HASH_ALGORITHM = "sha1"
+USB_VERIFY_SAMPLE_RATIO = 0.05
+# plugged USB disks are rescanned on (un)plug or after this delay (seconds)
+USB_DISKS_CACHE_TTL = 60
+
+# seconds Settings (ONA server, token…) are cached in each process: edits
+# reach long-running processes (run_jobs, socket_server) after that delay
+SETTINGS_CACHE_TTL = 30
+
+# precompiled labels of the social survey XLSForm
+FORM_LABELS_CACHE = os.path.join(BASE_DIR, "form_labels.json")
+
+# ONA HTTP client: keep-alive connection pool and retry policy
+ONA_HTTP_POOL_CONNECTIONS = 4  # number of per-host pools kept around
+ONA_HTTP_POOL_MAXSIZE = 16  # max simultaneous connections per host
+ONA_HTTP_MAX_RETRIES = 3
+ONA_HTTP_BACKOFF_FACTOR = 0.5
+# concurrent HEAD requests used to size attachments (<= ONA_HTTP_POOL_MAXSIZE)
+ONA_MEDIA_PROBE_CONCURRENCY = 8
+# reuse sizes found in submissions' attachments metadata (HEAD only if missing)
+ONA_TRUST_ATTACHMENTS_METADATA = True
+# submissions are downloaded and processed by pages of this size
+ONA_DATA_PAGE_SIZE = 100
+
 try:
     from hamed.settings_local import *
 except ImportError:
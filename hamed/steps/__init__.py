@@ -3,13 +3,115 @@
 # vim: ai ts=4 sts=4 et sw=4 nu
 
 import sys
+import time
 import logging
+import resource
 import traceback
 from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+from django.db import connection
 
 logger = logging.getLogger(__name__)
 
 
+def get_cpu_time():
+    """user+system CPU seconds of this process, threads and reaped children"""
+    return sum(
+        [
+            usage.ru_utime + usage.ru_stime
+            for usage in (
+                resource.getrusage(resource.RUSAGE_SELF),
+                resource.getrusage(resource.RUSAGE_CHILDREN),
+            )
+        ]
+    )
+
+
+def get_children_peak_memory():
+    """peak resident memory (bytes) of the largest reaped child, ever"""
+    return 1024 * resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+
+
+def reset_peak_memory():
+    """reset this process' resident memory high-water mark (linux only)"""
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+    except OSError:
+        return False
+    return True
+
+
+def get_peak_memory():
+    """peak resident memory (bytes) of this process since last reset"""
+    try:
+        with open("/proc/self/status", "r") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return 1024 * int(line.split()[1])
+    except OSError:
+        pass
+    # lifetime peak
+    return 1024 * resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+class TaskMetrics(object):
+    """wall time, CPU time, peak memory and item counts of a task
+
+    use as context manager around the measured code. Peak memory is the
+    process-wide high-water mark since entering (it is reset then) or the
+    one of a child process started meanwhile if larger. Both peak memory
+    and CPU time include tasks running concurrently, if any."""
+
+    def __init__(self):
+        self.started_on = None
+        self.wall_time = None
+        self.cpu_time = None
+        self.peak_memory = None
+        self.counts = {}
+
+    def __enter__(self):
+        self.started_on = time.time()
+        self._wall_start = time.perf_counter()
+        self._cpu_start = get_cpu_time()
+        self._children_peak_start = get_children_peak_memory()
+        reset_peak_memory()
+        return self
+
+    def __exit__(self, *args):
+        self.wall_time = time.perf_counter() - self._wall_start
+        self.cpu_time = get_cpu_time() - self._cpu_start
+        children_peak = get_children_peak_memory()
+        self.peak_memory = max(
+            get_peak_memory(),
+            children_peak if children_peak > self._children_peak_start else 0,
+        )
+        return False
+
+    def count(self, key, nb=1):
+        self.counts[key] = self.counts.get(key, 0) + nb
+
+    def to_dict(self):
+        return {
+            "started_on": self.started_on,
+            "wall_time": self.wall_time,
+            "cpu_time": self.cpu_time,
+            "peak_memory": self.peak_memory,
+            "counts": self.counts,
+        }
+
+
+def rewind_streams(outputs):
+    """seek file-like outputs (StringIO, BytesIO…) back to their start
+
+    consumers (uploads) read them to EOF so they'd be empty once resumed."""
+    for value in outputs.values():
+        if hasattr(value, "seek"):
+            value.seek(0)
+    return outputs
+
+
 class BaseTask(object):
     NOT_STARTED = "not-started"
     STARTED = "started"
@@ -18,6 +120,7 @@ class BaseTask(object):
     REVERTING = "reverting"
     REVERTED = "reverted"
     ERROR = "error"
+    SUSPENDED = "suspended"
 
     STATUSES = OrderedDict(
         [
@@ -28,6 +131,7 @@ class BaseTask(object):
             (REVERTING, "Failed. Reverting in progress"),
             (REVERTED, "Reverted"),
             (ERROR, "Failed to revert properly"),
+            (SUSPENDED, "Failed. Completed tasks kept, can be resumed"),
         ]
     )
 
@@ -45,6 +149,7 @@ class BaseTask(object):
     def __init__(self, **kwargs):
         self.kwargs = kwargs
         self.output = {}
+        self.metrics = TaskMetrics()
 
     @property
     def name(self):
@@ -62,9 +167,13 @@ class BaseTask(object):
     def clean_state(self):
         return self.status in self.CLEAN_STATUSES
 
+    @property
+    def suspended(self):
+        return self.status == self.SUSPENDED
+
     @property
     def exception(self):
-        if self.status in (self.FAILED, self.REVERTING, self.REVERTED):
+        if self.status in (self.FAILED, self.REVERTING, self.REVERTED, self.SUSPENDED):
             return self.processing_exception
         elif self.status == self.ERROR:
             return self.reverting_exception
@@ -73,7 +182,7 @@ class BaseTask(object):
 
     @property
     def traceback(self):
-        if self.status in (self.FAILED, self.REVERTING, self.REVERTED):
+        if self.status in (self.FAILED, self.REVERTING, self.REVERTED, self.SUSPENDED):
             return self.processing_traceback
         elif self.status == self.ERROR:
             return self.reverting_traceback
@@ -89,6 +198,13 @@ class Task(BaseTask):
     required_inputs = []
     required_outputs = []
 
+    # names of previous tasks of the collection this one must run after,
+    # in addition to those providing its required_inputs. "*" for all.
+    depends_on = []
+
+    # never run concurrently with other tasks (forks processes…)
+    exclusive = False
+
     def process(self):
         logger.debug("PROCESSING {}".format(self.name))
 
@@ -100,7 +216,8 @@ class Task(BaseTask):
                 if key not in self.kwargs.keys():
                     raise Exception("required_input missing: {}".format(key))
 
-            self._process()
+            with self.metrics:
+                self._process()
 
             # ensure all required output has been created
             for key in self.required_outputs:
@@ -144,6 +261,10 @@ class Task(BaseTask):
         if key in self.output:
             del self.output[key]
 
+    def count(self, key, nb=1):
+        """record nb items of kind key (submissions, pdfs…) handled by task"""
+        self.metrics.count(key, nb)
+
 
 class TaskFailed(Exception):
     pass
@@ -152,17 +273,141 @@ class TaskFailed(Exception):
 class TaskCollection(BaseTask):
     tasks = []
 
-    def __init__(self, **kwargs):
+    # on failure, keep completed tasks and save a checkpoint to resume from
+    # instead of reverting them all. Requires a checkpoint store.
+    resumable = False
+
+    # run tasks in threads as soon as their dependencies are completed
+    # (see get_dependencies). Tasks must declare them all.
+    parallel = False
+    max_workers = 4
+
+    def __init__(self, progress_callback=None, checkpoint=None, **kwargs):
         super(TaskCollection, self).__init__(**kwargs)
         self.instances = []
+        # all tasks processed, in order (instances is emptied on revert)
+        self.processed = []
         self.inputs = kwargs
+        # called with (collection, nb of tasks done, task name) on changes
+        self.progress_callback = progress_callback
+        # store with load(), save(completed, outputs) and discard()
+        self.checkpoint = checkpoint
+        # names of completed tasks and their outputs (for checkpoint)
+        self.completed = []
+        self.completed_outputs = {}
+
+    @property
+    def can_suspend(self):
+        return self.resumable and self.checkpoint is not None
+
+    def restore_checkpoint(self):
+        """load completed tasks and their outputs from a suspended run"""
+        if self.checkpoint is None:
+            return
+        state = self.checkpoint.load()
+        if not state:
+            return
+        logger.info(
+            "Resuming {name} after {tasks}".format(
+                name=self.name, tasks=", ".join(state["completed"])
+            )
+        )
+        self.completed = list(state["completed"])
+        self.completed_outputs = rewind_streams(dict(state["outputs"]))
+        self.inputs.update(self.completed_outputs)
+
+    def discard_checkpoint(self):
+        if self.checkpoint is None:
+            return
+        try:
+            self.checkpoint.discard()
+        except Exception as exp:
+            logger.error("Unable to discard checkpoint of {}".format(self.name))
+            logger.exception(exp)
+
+    def suspend(self, index):
+        """keep completed tasks and checkpoint them, revert if impossible"""
+        try:
+            self.checkpoint.save(
+                completed=self.completed,
+                outputs=rewind_streams(self.completed_outputs),
+            )
+        except Exception as exp:
+            logger.error("Unable to save checkpoint of {}".format(self.name))
+            logger.exception(exp)
+            self.revert(index)
+        else:
+            logger.info(
+                "Suspended task collection {name} at task #{index}".format(
+                    name=self.name, index=index
+                )
+            )
+            self.update_status(self.SUSPENDED)
+
+    @property
+    def nb_tasks(self):
+        return len(self.tasks)
+
+    def notify_progress(self, nb_done, task_name):
+        if self.progress_callback is None:
+            return
+        try:
+            self.progress_callback(self, nb_done, task_name)
+        except Exception as exp:
+            logger.error("Progress callback failed for {}".format(self.name))
+            logger.exception(exp)
+
+    def log_metrics(self):
+        for task in self.processed:
+            logger.info(
+                "{task}: {wall:.2f}s wall, {cpu:.2f}s CPU, {counts}".format(
+                    task=task.name,
+                    wall=task.metrics.wall_time or 0,
+                    cpu=task.metrics.cpu_time or 0,
+                    counts=task.metrics.counts,
+                )
+            )
 
     def process(self):
         self.update_status(self.STARTED)
 
+        with self.metrics:
+            self._process_tasks()
+        # each task reset the high-water mark: ours only covers the last one
+        self.metrics.peak_memory = max(
+            [self.metrics.peak_memory or 0]
+            + [task.metrics.peak_memory or 0 for task in self.processed]
+        )
+        self.log_metrics()
+
+    @classmethod
+    def get_dependencies(cls):
+        """{task name: names of the previous tasks it depends on}
+
+        a task depends on tasks providing one of its required_inputs and
+        on those listed in its depends_on. Only previous tasks are
+        considered so tasks order is always a valid execution order."""
+        dependencies = OrderedDict()
+        for index, task_cls in enumerate(cls.tasks):
+            dependencies[task_cls.__name__] = [
+                previous.__name__
+                for previous in cls.tasks[:index]
+                if "*" in task_cls.depends_on
+                or previous.__name__ in task_cls.depends_on
+                or set(task_cls.required_inputs) & set(previous.required_outputs)
+            ]
+        return dependencies
+
+    def _process_tasks(self):
+        self.restore_checkpoint()
+
+        if self.parallel:
+            return self._process_tasks_concurrently()
+
         try:
             for index, task_cls in enumerate(self.tasks):
                 logger.debug("Initiating Task #{}".format(index))
+                self.notify_progress(index, task_cls.__name__)
 
                 # should never happen unless task is improperly written
                 try:
@@ -174,6 +419,14 @@ class TaskCollection(BaseTask):
                 # keep reference of task so we can revert it if required
                 self.instances.append(task)
 
+                # completed during a previous (suspended) run
+                if task.name in self.completed:
+                    logger.debug("Task #{} restored from checkpoint".format(index))
+                    task.update_status(task.SUCCESS)
+                    continue
+
+                self.processed.append(task)
+
                 # process task or raise to stop loop and revert
                 try:
                     task.process()
@@ -189,12 +442,107 @@ class TaskCollection(BaseTask):
                 else:
                     # update outputs to include task's output
                     self.inputs.update(task.output)
+                    self.completed.append(task.name)
+                    self.completed_outputs.update(task.output)
                     logger.info("Successfuly processed task #{}".format(index))
         except TaskFailed:
-            self.revert(index)
+            # failed task reverted itself: previous ones can be kept
+            if self.can_suspend and task.reverted:
+                self.suspend(index)
+            else:
+                self.revert(index)
         else:
             logger.info("Successfuly processed task collection {}".format(self.name))
             self.update_status(self.SUCCESS)
+            self.notify_progress(self.nb_tasks, None)
+            self.discard_checkpoint()
+
+    def _process_tasks_concurrently(self):
+        dependencies = self.get_dependencies()
+        pending = []
+        for task_cls in self.tasks:
+            if task_cls.__name__ in self.completed:
+                # completed during a previous (suspended) run
+                task = task_cls(**self.inputs)
+                task.update_status(task.SUCCESS)
+                self.instances.append(task)
+            else:
+                pending.append(task_cls)
+
+        failed = []
+        running = {}
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            while pending or running:
+                # start all tasks which dependencies are completed (none on failure)
+                ready = [
+                    task_cls
+                    for task_cls in pending
+                    if not failed
+                    and all(
+                        [
+                            name in self.completed
+                            for name in dependencies[task_cls.__name__]
+                        ]
+                    )
+                ]
+                # exclusive tasks run alone, once running ones are done
+                exclusives = [task_cls for task_cls in ready if task_cls.exclusive]
+                if any([task.exclusive for task in running.values()]):
+                    ready = []
+                elif exclusives:
+                    ready = [] if running else exclusives[:1]
+                for task_cls in ready:
+                    pending.remove(task_cls)
+                    task = task_cls(**self.inputs)
+                    self.processed.append(task)
+                    self.notify_progress(len(self.completed), task.name)
+                    running[executor.submit(self.run_task, task)] = task
+
+                if not running:
+                    break
+
+                done, _ = wait(running.keys(), return_when=FIRST_COMPLETED)
+                for future in sorted(
+                    done, key=lambda f: self.tasks.index(type(running[f]))
+                ):
+                    task = running.pop(future)
+                    # instances are reverted in reverse order of completion
+                    self.instances.append(task)
+                    if task.successful:
+                        self.inputs.update(task.output)
+                        self.completed.append(task.name)
+                        self.completed_outputs.update(task.output)
+                        logger.info("Successfuly processed task {}".format(task.name))
+                    else:
+                        logger.error(
+                            "Failed to process task {}: {}".format(
+                                task.name, task.processing_exception
+                            )
+                        )
+                        failed.append(task)
+
+        if failed:
+            self.processing_exception = failed[0].processing_exception
+            self.processing_traceback = failed[0].processing_traceback
+            # failed tasks reverted themselves: completed ones can be kept
+            if self.can_suspend and all([task.reverted for task in failed]):
+                self.suspend(len(self.instances) - 1)
+            else:
+                self.revert(len(self.instances) - 1)
+        else:
+            logger.info("Successfuly processed task collection {}".format(self.name))
+            self.update_status(self.SUCCESS)
+            self.notify_progress(self.nb_tasks, None)
+            self.discard_checkpoint()
+
+    def run_task(self, task):
+        """process task in a worker thread"""
+        try:
+            task.process()
+        finally:
+            # each thread has its own database connection
+            connection.close()
+        return task
 
     def revert(self, index):
         logger.info("Reverting Task Colection {}".format(self.name))
@@ -204,6 +552,7 @@ class TaskCollection(BaseTask):
             for rb_index in range(index, -1, -1):
                 logger.debug("Calling revert on task #{}".format(rb_index))
                 task = self.instances.pop()
+                self.notify_progress(rb_index, task.name)
                 if task.status not in (self.REVERTED, self.REVERTING, self.ERROR):
                     try:
                         task.revert()
@@ -222,10 +571,15 @@ class TaskCollection(BaseTask):
         else:
             logger.info("Successfuly reverted task collection {}".format(self.name))
             self.update_status(self.REVERTED)
+            # nothing left to resume
+            self.discard_checkpoint()
 
     def revert_all(self):
         self.update_status(self.REVERTING)
 
+        # outputs of a suspended run help reverting its tasks
+        self.restore_checkpoint()
+
         # instanciate all tasks (without processing them)
         try:
             for index, task_cls in enumerate(self.tasks):
@@ -11,7 +11,6 @@ from hamed.ona import (
     delete_form,
     disable_form,
     enable_form,
-    get_form_data,
     upload_csv_media,
     delete_media,
     get_media_id,
@@ -19,6 +18,7 @@ from hamed.ona import (
 from hamed.utils import (
     gen_targets_documents,
     remove_targets_documents,
+    remove_orphan_documents,
     share_form,
     unshare_form,
 )
@@ -43,10 +43,11 @@ class DisableONAForm(Task):
 class DownloadData(Task):
     required_inputs = ["collect"]
     required_outputs = ["data"]
+    depends_on = ["DisableONAForm"]
 
     def _process(self):
-        """retrieve ONA data for form"""
-        self.output["data"] = get_form_data(self.kwargs["collect"].ona_form_pk)
+        """retrieve ONA data not synced yet (lazily, page by page)"""
+        self.output["data"] = self.kwargs["collect"].get_form_data()
 
     def _revert(self):
         """release collected data for form"""
@@ -58,29 +59,53 @@ class AddONADataToCollect(Task):
 
     def _process(self):
         """populate Collect with retrieved data and create Targets"""
-        self.kwargs["collect"].process_form_data(self.kwargs["data"])
+        # targets synced before are kept on revert
+        self.kwargs["collect"].refresh_from_db(fields=["last_synced_id"])
+        self.output["synced_from"] = self.kwargs["collect"].last_synced_id
+        targets = self.kwargs["collect"].process_form_data(self.kwargs["data"])
+        self.count("submissions", len(targets))
+        self.count(
+            "attachments",
+            sum([len(t.form_dataset.get("_attachments", [])) for t in targets]),
+        )
 
     def _revert(self):
-        """delete created targets and empty data-fields on Collect"""
-        self.kwargs["collect"].reset_form_data()
+        """delete targets created by this run (all on cold revert)"""
+        if "synced_from" in self.output:
+            synced_from = self.output["synced_from"]
+        else:
+            # restored from checkpoint or cold revert (None)
+            synced_from = self.kwargs.get("synced_from")
+        self.kwargs["collect"].remove_form_data_since(synced_from)
 
 
 class GenerateTargetsDocuments(Task):
     required_inputs = ["collect"]
+    depends_on = ["AddONADataToCollect"]
+    # forks its rendering processes: no other thread must be mid-request
+    exclusive = True
 
     def _process(self):
-        """generate documents for all targets"""
-        gen_targets_documents(self.kwargs["collect"].targets.all())
+        """generate outdated documents for all targets, remove orphans ones"""
+        stats = gen_targets_documents(self.kwargs["collect"].targets.all())
+        self.count("pdfs", stats["rendered"] * 3)
+        remove_orphan_documents(self.kwargs["collect"])
 
     def _revert(self):
-        """remove generated documents for targets"""
+        """remove documents of targets created by this run (all on cold revert)"""
         if self.kwargs.get("collect"):
-            remove_targets_documents(self.kwargs["collect"].targets.all())
+            # targets synced before are kept (see AddONADataToCollect)
+            remove_targets_documents(
+                self.kwargs["collect"].get_targets_synced_after(
+                    self.kwargs.get("synced_from")
+                )
+            )
 
 
 class GenerateItemsetsCSV(Task):
     required_inputs = ["collect"]
     required_outputs = ["targets_csv"]
+    depends_on = ["AddONADataToCollect"]
 
     def _process(self):
         """generate itemsets CSV for targets"""
@@ -110,6 +135,8 @@ class GenerateScanXLSForm(Task):
 
 class UploadXLSForm(Task):
     required_inputs = ["collect", "xlsx"]
+    # scan form is only published once data is frozen and imported
+    depends_on = ["AddONADataToCollect"]
 
     def _process(self):
         """upload scan xlsform to ONA"""
@@ -130,6 +157,8 @@ class UploadXLSForm(Task):
 
 
 class ShareForm(Task):
+    depends_on = ["UploadXLSForm"]
+
     def _process(self):
         """add agent user permission to submit to form"""
         share_form(self.kwargs["collect"].ona_scan_form_pk)
@@ -144,6 +173,7 @@ class ShareForm(Task):
 class AddItemsetsToONAForm(Task):
     required_inputs = ["collect", "targets_csv"]
     required_outputs = ["uploaded_csv"]
+    depends_on = ["UploadXLSForm"]
 
     def _process(self):
         """upload itemsets CSV to ONA as media"""
@@ -168,6 +198,7 @@ class AddItemsetsToONAForm(Task):
 
 class MarkCollectAsEnded(Task):
     required_inputs = ["collect"]
+    depends_on = ["*"]
 
     def _process(self):
         """change collect status to ENDED"""
@@ -179,6 +210,9 @@ class MarkCollectAsEnded(Task):
 
 
 class EndCollectTaskCollection(TaskCollection):
+    # downloading data and generating documents is too long to be redone
+    resumable = True
+    parallel = True
     tasks = [
         DisableONAForm,
         DownloadData,
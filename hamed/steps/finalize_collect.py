@@ -2,10 +2,11 @@
 # -*- coding: utf-8 -*-
 # vim: ai ts=4 sts=4 et sw=4 nu
 
+import json
 import logging
 
 from hamed.steps import Task, TaskCollection
-from hamed.ona import disable_form, enable_form, get_form_data
+from hamed.ona import disable_form, enable_form, LazyFormData
 from hamed.utils import (
     export_collect_data,
     remove_exported_collect_data,
@@ -33,10 +34,15 @@ class DisableONAScanForm(Task):
 class DownloadScanData(Task):
     required_inputs = ["collect"]
     required_outputs = ["data"]
+    depends_on = ["DisableONAScanForm"]
 
     def _process(self):
-        """retrieve ONA data for form"""
-        self.output["data"] = get_form_data(self.kwargs["collect"].ona_scan_form_pk)
+        """retrieve ONA data for form (lazily, page by page on iteration)"""
+        # stable order so pages don't skip or repeat submissions
+        self.output["data"] = LazyFormData(
+            self.kwargs["collect"].ona_scan_form_pk,
+            params={"sort": json.dumps({"_id": 1})},
+        )
 
     def _revert(self):
         """release collected data for form"""
@@ -49,7 +55,8 @@ class AddONAScanDataToCollect(Task):
 
     def _process(self):
         """populate Collect with retrieved data and create Targets"""
-        self.kwargs["collect"].process_scan_form_data(self.kwargs["data"])
+        nb_scans = self.kwargs["collect"].process_scan_form_data(self.kwargs["data"])
+        self.count("submissions", nb_scans)
 
     def _revert(self):
         """delete created targets and empty data-fields on Collect"""
@@ -58,6 +65,7 @@ class AddONAScanDataToCollect(Task):
 
 class ExportAllData(Task):
     required_inputs = ["collect"]
+    depends_on = ["AddONAScanDataToCollect"]
 
     def _process(self):
         """export complete JSON data to file and medias"""
@@ -71,19 +79,25 @@ class ExportAllData(Task):
 
 class ExportAllMedias(Task):
     required_inputs = ["collect"]
+    depends_on = ["AddONAScanDataToCollect"]
 
     def _process(self):
-        """export complete JSON data to file and medias"""
-        export_collect_medias(self.kwargs["collect"])
+        """export all medias to targets' folders"""
+        self.output["medias_stats"] = export_collect_medias(self.kwargs["collect"])
+        self.count("attachments", self.output["medias_stats"]["files"])
 
     def _revert(self):
-        """remove such files (JSON export and all medias) from disk"""
+        """remove medias from disk unless export failed (retry resumes it)"""
+        if self.processing_exception is not None:
+            # complete medias are skipped and partial ones resumed on retry
+            return
         if self.kwargs.get("collect"):
             remove_collect_medias(self.kwargs["collect"])
 
 
 class MarkCollectAsFinalized(Task):
     required_inputs = ["collect"]
+    depends_on = ["*"]
 
     def _process(self):
         """change collect status to ENDED"""
@@ -95,6 +109,9 @@ class MarkCollectAsFinalized(Task):
 
 
 class FinalizeCollectTaskCollection(TaskCollection):
+    # medias export is too long to be redone
+    resumable = True
+    parallel = True
     tasks = [
         DisableONAScanForm,
         DownloadScanData,
@@ -2,6 +2,7 @@
 # -*- coding: utf-8 -*-
 # vim: ai ts=4 sts=4 et sw=4 nu
 
+import json
 import logging
 
 from hamed.steps import Task, TaskCollection
@@ -11,7 +12,7 @@ from hamed.ona import (
     delete_form,
     disable_form,
     enable_form,
-    get_form_data,
+    LazyFormData,
     upload_csv_media,
     delete_media,
     get_media_id,
@@ -54,7 +55,10 @@ class RemoveFormData(Task):
         if not self.kwargs.get("collect"):
             logger.error("Collect not in kwargs")
             return
-        self.output["data"] = get_form_data(self.kwargs["collect"].ona_form_pk)
+        # stable order so pages don't skip or repeat submissions
+        self.output["data"] = LazyFormData(
+            self.kwargs["collect"].ona_form_pk, params={"sort": json.dumps({"_id": 1})}
+        )
 
 
 class ResetONAData(Task):
@@ -0,0 +1,30 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim: ai ts=4 sts=4 et sw=4 nu
+
+import logging
+
+from hamed.steps import Task, TaskCollection
+
+logger = logging.getLogger(__name__)
+
+
+class SyncONAData(Task):
+    required_inputs = ["collect"]
+
+    def _process(self):
+        """import new submissions and pre-render their documents"""
+        collect = self.kwargs["collect"]
+        # collect might have been ended since the sync was queued
+        if collect.status != collect.STARTED:
+            logger.info("{} not started anymore, not syncing".format(collect))
+            return
+        self.count("submissions", len(collect.sync_form_data()))
+
+    def _revert(self):
+        """keep imported pages: next sync resumes from last_synced_id"""
+        pass
+
+
+class SyncCollectTaskCollection(TaskCollection):
+    tasks = [SyncONAData]
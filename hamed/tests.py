@@ -0,0 +1,426 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim: ai ts=4 sts=4 et sw=4 nu
+
+import io
+import json
+import time
+import pickle
+import unittest
+import threading
+from unittest import mock
+
+from hamed.steps import Task, TaskCollection
+from hamed.ona import iter_json_array, LazyFormData
+from hamed.identifiers import IdentifierAllocator, full_id_for, CHARACTERS_POOL
+
+
+class MemoryCheckpointStore(object):
+    """checkpoint store pickling to memory, as CheckpointStore does to DB"""
+
+    def __init__(self):
+        self.state = None
+
+    def load(self):
+        return pickle.loads(self.state) if self.state else None
+
+    def save(self, completed, outputs):
+        self.state = pickle.dumps({"completed": completed, "outputs": outputs})
+
+    def discard(self):
+        self.state = None
+
+
+class GenerateCSV(Task):
+    required_outputs = ["csv"]
+
+    def _process(self):
+        self.output["csv"] = io.StringIO("a,b\n1,2\n")
+
+
+class UploadCSV(Task):
+    required_inputs = ["csv", "server"]
+
+    def _process(self):
+        # reads stream to EOF, like requests does, then fails (once)
+        server = self.kwargs["server"]
+        server["uploaded"].append(self.kwargs["csv"].read())
+        if server["fail"]:
+            server["fail"] = False
+            raise IOError("connection reset")
+
+
+class UploadTaskCollection(TaskCollection):
+    resumable = True
+    tasks = [GenerateCSV, UploadCSV]
+
+
+class ResumeTaskCollectionTest(unittest.TestCase):
+    def setUp(self):
+        # fake ONA server, failing the first upload
+        self.server = {"uploaded": [], "fail": True}
+
+    def test_resume_after_failed_upload(self):
+        store = MemoryCheckpointStore()
+
+        collection = UploadTaskCollection(checkpoint=store, server=self.server)
+        collection.process()
+        self.assertTrue(collection.suspended)
+
+        collection = UploadTaskCollection(checkpoint=store, server=self.server)
+        collection.process()
+        self.assertTrue(collection.successful)
+        self.assertEqual(self.server["uploaded"], ["a,b\n1,2\n", "a,b\n1,2\n"])
+        self.assertIsNone(store.state)
+
+
+class TasksLog(object):
+    """thread-safe record of tasks' start, end and revert events"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.events = []
+
+    def add(self, event, name):
+        with self.lock:
+            self.events.append((event, name, time.monotonic()))
+
+    def names(self, event):
+        return [name for ev, name, _ in self.events if ev == event]
+
+    def get_time(self, event, name):
+        return [at for ev, n, at in self.events if ev == event and n == name][0]
+
+    def overlaps(self, name, other):
+        return self.get_time("start", name) < self.get_time(
+            "end", other
+        ) and self.get_time("start", other) < self.get_time("end", name)
+
+
+class StubTask(Task):
+    required_inputs = ["log"]
+    # seconds spent processing
+    duration = 0.05
+
+    def _process(self):
+        self.kwargs["log"].add("start", self.name)
+        self.work()
+        time.sleep(self.duration)
+        self.kwargs["log"].add("end", self.name)
+
+    def work(self):
+        pass
+
+    def _revert(self):
+        self.kwargs["log"].add("revert", self.name)
+
+
+class Download(StubTask):
+    pass
+
+
+class Render(StubTask):
+    depends_on = ["Download"]
+
+    def work(self):
+        # fails unless Upload runs at the same time
+        self.kwargs["barrier"].wait()
+
+
+class Upload(StubTask):
+    depends_on = ["Download"]
+
+    def work(self):
+        self.kwargs["barrier"].wait()
+
+
+class Finish(StubTask):
+    depends_on = ["*"]
+
+
+class ParallelTaskCollection(TaskCollection):
+    parallel = True
+    tasks = [Download, Render, Upload, Finish]
+
+
+class ExclusiveRender(StubTask):
+    depends_on = ["Download"]
+    exclusive = True
+
+
+class Publish(StubTask):
+    depends_on = ["Download"]
+
+
+class Share(StubTask):
+    depends_on = ["Download"]
+
+
+class ExclusiveTaskCollection(TaskCollection):
+    parallel = True
+    tasks = [Download, ExclusiveRender, Publish, Share, Finish]
+
+
+class FailingUpload(StubTask):
+    depends_on = ["Download"]
+
+    def work(self):
+        # fail once Share is done so it has to be reverted
+        self.kwargs["shared"].wait(timeout=2)
+        raise IOError("connection reset")
+
+
+class SignalingShare(StubTask):
+    depends_on = ["Download"]
+
+    def work(self):
+        self.kwargs["shared"].set()
+
+
+class FailingTaskCollection(TaskCollection):
+    parallel = True
+    tasks = [Download, SignalingShare, FailingUpload, Finish]
+
+
+class ParallelTaskCollectionTest(unittest.TestCase):
+    def setUp(self):
+        self.log = TasksLog()
+
+    def test_dependencies(self):
+        self.assertEqual(
+            ParallelTaskCollection.get_dependencies(),
+            {
+                "Download": [],
+                "Render": ["Download"],
+                "Upload": ["Download"],
+                "Finish": ["Download", "Render", "Upload"],
+            },
+        )
+
+    def test_tasks_run_after_dependencies(self):
+        collection = ParallelTaskCollection(
+            log=self.log, barrier=threading.Barrier(2, timeout=2)
+        )
+        collection.process()
+        self.assertTrue(collection.successful)
+
+        # independent tasks ran concurrently (barrier), after their dependency
+        self.assertTrue(self.log.overlaps("Render", "Upload"))
+        for name in ("Render", "Upload"):
+            self.assertGreaterEqual(
+                self.log.get_time("start", name), self.log.get_time("end", "Download")
+            )
+            self.assertGreaterEqual(
+                self.log.get_time("start", "Finish"), self.log.get_time("end", name)
+            )
+
+    def test_exclusive_task_runs_alone(self):
+        collection = ExclusiveTaskCollection(log=self.log)
+        collection.process()
+        self.assertTrue(collection.successful)
+
+        self.assertEqual(len(self.log.names("end")), 5)
+        for name in ("Download", "Publish", "Share", "Finish"):
+            self.assertFalse(self.log.overlaps("ExclusiveRender", name))
+        self.assertTrue(self.log.overlaps("Publish", "Share"))
+
+    def test_failure_reverts_completed_tasks_in_reverse_order(self):
+        collection = FailingTaskCollection(log=self.log, shared=threading.Event())
+        collection.process()
+
+        self.assertTrue(collection.reverted)
+        self.assertIsInstance(collection.exception, IOError)
+        # failed task reverted itself first, dependent one never started
+        self.assertEqual(
+            self.log.names("revert"), ["FailingUpload", "SignalingShare", "Download"]
+        )
+        self.assertNotIn("Finish", self.log.names("start"))
+
+    def test_threads_close_their_database_connection(self):
+        with mock.patch("hamed.steps.connection") as connection:
+            collection = ParallelTaskCollection(
+                log=self.log, barrier=threading.Barrier(2, timeout=2)
+            )
+            collection.process()
+        self.assertTrue(collection.successful)
+        self.assertEqual(connection.close.call_count, 4)
+
+    def test_collection_peak_memory_is_largest_task_peak(self):
+        # five tasks then the collection itself read the high-water mark
+        peaks = iter([300, 100, 100, 100, 100, 50])
+        with mock.patch("hamed.steps.reset_peak_memory"), mock.patch(
+            "hamed.steps.get_peak_memory", side_effect=lambda: next(peaks)
+        ):
+            collection = ExclusiveTaskCollection(log=self.log)
+            collection.process()
+        self.assertTrue(collection.successful)
+        self.assertEqual(collection.metrics.peak_memory, 300)
+
+
+class FakeResponse(object):
+    """streamed requests response made of fixed byte chunks"""
+
+    def __init__(self, chunks, status_code=200):
+        self.chunks = chunks
+        self.status_code = status_code
+        self.encoding = "utf-8"
+        self.text = ""
+        self.closed = False
+
+    def iter_content(self, chunk_size=1):
+        return iter(self.chunks)
+
+    def json(self):
+        return {}
+
+    def close(self):
+        self.closed = True
+
+
+def split_every(data, size):
+    return [data[i : i + size] for i in range(0, len(data), size)]
+
+
+class IterJSONArrayTest(unittest.TestCase):
+    items = [
+        {"_id": 123, "name": "Fatoumata Traoré", "note": "a ], b, [c] {d}"},
+        {"quote": 'say "hi"\\', "nested": {"list": [1, 2.5, -3e2, None, True]}},
+        1234567,
+        "],[",
+        [],
+    ]
+
+    def setUp(self):
+        self.payload = json.dumps(self.items, ensure_ascii=False, indent=1)
+
+    def test_any_chunk_boundary(self):
+        for index in range(len(self.payload) + 1):
+            chunks = [self.payload[:index], self.payload[index:]]
+            self.assertEqual(list(iter_json_array(chunks)), self.items, index)
+
+    def test_tiny_chunks(self):
+        for size in (1, 2, 3, 7):
+            chunks = split_every(self.payload, size)
+            self.assertEqual(list(iter_json_array(chunks)), self.items, size)
+
+    def test_empty_array(self):
+        self.assertEqual(list(iter_json_array(["[]"])), [])
+        self.assertEqual(list(iter_json_array([" [", "", " ] "])), [])
+
+    def test_invalid_payloads(self):
+        with self.assertRaises(ValueError):
+            list(iter_json_array(['{"detail": "Not found."}']))
+        with self.assertRaises(ValueError):
+            list(iter_json_array(['[{"_id": 1}, {"_id"']))
+        with self.assertRaises(ValueError):
+            list(iter_json_array([]))
+
+
+class LazyFormDataTest(unittest.TestCase):
+    def iterate(self, pages, page_size=2, params={}):
+        """submissions and requests' params for pages of responses"""
+        session = mock.Mock()
+        session.get.side_effect = pages
+        with mock.patch("hamed.ona.get_session", return_value=session), mock.patch(
+            "hamed.ona.get_url", side_effect=lambda path: path
+        ), mock.patch("hamed.ona.get_auth_header", return_value={}):
+            data = list(LazyFormData(1, page_size=page_size, params=params))
+        return data, [call[1]["params"] for call in session.get.call_args_list]
+
+    def page(self, ids, chunk_size=5):
+        payload = json.dumps([{"_id": i, "nom": "Sékou"} for i in ids])
+        return FakeResponse(split_every(payload.encode("UTF-8"), chunk_size))
+
+    def test_last_short_page(self):
+        data, params = self.iterate(
+            [self.page([1, 2]), self.page([3])], params={"sort": '{"_id": 1}'}
+        )
+        self.assertEqual([s["_id"] for s in data], [1, 2, 3])
+        self.assertEqual(
+            params,
+            [
+                {"sort": '{"_id": 1}', "page": 1, "page_size": 2},
+                {"sort": '{"_id": 1}', "page": 2, "page_size": 2},
+            ],
+        )
+
+    def test_multibyte_characters_split(self):
+        # odd chunks cut the 2 bytes of `é` in half
+        data, _ = self.iterate([self.page([1], chunk_size=3)])
+        self.assertEqual(data, [{"_id": 1, "nom": "Sékou"}])
+
+    def test_empty_pages(self):
+        data, params = self.iterate([self.page([])])
+        self.assertEqual(data, [])
+        self.assertEqual(len(params), 1)
+
+        # full last page: next one is empty or a 404
+        data, params = self.iterate([self.page([1, 2]), self.page([])])
+        self.assertEqual([s["_id"] for s in data], [1, 2])
+        data, params = self.iterate([self.page([1, 2]), FakeResponse([], 404)])
+        self.assertEqual([s["_id"] for s in data], [1, 2])
+        self.assertEqual(len(params), 2)
+
+
+class IdentifierAllocatorTest(unittest.TestCase):
+    def get_allocator(self, used=[]):
+        # tiny space of 2^3 = 8 identifiers
+        return IdentifierAllocator(used=used, length=3, pool="AB")
+
+    def assertValid(self, allocator, identifiers):
+        for ident in identifiers:
+            base = ident[: allocator.length]
+            self.assertTrue(set(base) <= set(allocator.pool), ident)
+            self.assertEqual(ident, full_id_for(base))
+
+    def test_reserve(self):
+        allocator = self.get_allocator(used=[full_id_for("AAA")])
+        ident = full_id_for("ABA")
+        self.assertEqual(allocator.reserve([full_id_for("AAA"), ident]), [ident])
+        self.assertEqual(allocator.reserve([ident]), [])
+        self.assertNotIn(ident, allocator.allocate(allocator.nb_free))
+
+    def test_allocate_distinct_and_unused(self):
+        allocator = IdentifierAllocator()
+        used = set(allocator.allocate(1000))
+        self.assertEqual(len(used), 1000)
+        self.assertValid(allocator, used)
+
+        allocator = IdentifierAllocator(used=used)
+        fresh = allocator.allocate(1000)
+        self.assertEqual(len(set(fresh)), 1000)
+        self.assertFalse(used & set(fresh))
+        self.assertEqual(allocator.nb_used, 2000)
+        self.assertEqual(allocator.capacity, len(CHARACTERS_POOL) ** 4)
+
+    def test_random_then_enumerated(self):
+        allocator = self.get_allocator()
+        with mock.patch.object(
+            allocator, "_allocate_enumerated", wraps=allocator._allocate_enumerated
+        ) as enumerated:
+            # 3/8 used once allocated: under ENUMERATION_THRESHOLD
+            first = allocator.allocate(3)
+            self.assertFalse(enumerated.called)
+            # 6/8: over the threshold
+            second = allocator.allocate(3)
+            self.assertTrue(enumerated.called)
+        self.assertEqual(len(set(first + second)), 6)
+        self.assertValid(allocator, first + second)
+
+    def test_exhaustion(self):
+        allocator = self.get_allocator(used=[full_id_for("AAA")])
+        idents = allocator.allocate(7)
+        self.assertEqual(len(set(idents + [full_id_for("AAA")])), 8)
+        self.assertEqual(allocator.nb_free, 0)
+        self.assertEqual(allocator.allocate(0), [])
+        with self.assertRaises(Exception):
+            allocator.allocate(1)
+
+    def test_too_many_requested(self):
+        allocator = self.get_allocator()
+        allocator.allocate(5)
+        with self.assertRaises(Exception):
+            allocator.allocate(4)
+        # nothing was reserved by the failed request
+        self.assertEqual(allocator.nb_used, 5)
+        self.assertEqual(len(allocator.allocate(3)), 3)
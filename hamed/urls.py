@@ -28,6 +28,8 @@ urlpatterns = [
         views.reopen_collect,
         name="reopen_collect",
     ),
+    url(r"^job/(?P<job_id>[0-9]+)/?$", views.job, name="job"),
+    url(r"^job/(?P<job_id>[0-9]+)/status/?$", views.job_status, name="job_status"),
     url(
         r"attachment/(?P<fname>[a-zA-Z0-9\-\_\.]+)",
         views.attachment_proxy,
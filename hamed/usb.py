@@ -0,0 +1,508 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim: ai ts=4 sts=4 et sw=4 nu
+
+import os
+import json
+import math
+import mmap
+import time
+import random
+import sys
+import hashlib
+import logging
+import zipfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import humanfriendly
+from django.conf import settings
+
+from hamed.constants import PERSONAL_FILES, PRINTS
+
+logger = logging.getLogger(__name__)
+
+PAGE_SIZE = mmap.PAGESIZE
+
+FILES_MODE = "files"
+ARCHIVE_MODE = "archive"
+MODES = (FILES_MODE, ARCHIVE_MODE)
+
+# collect folders packed into archives in ARCHIVE_MODE (others are copied)
+ARCHIVED_FOLDERS = (PERSONAL_FILES, PRINTS)
+COMPRESSIONS = {"stored": zipfile.ZIP_STORED, "deflate": zipfile.ZIP_DEFLATED}
+MANIFEST_FNAME = "manifest.json"
+
+DISKS_BY_PATH = "/dev/disk/by-path"
+SYSFS_BLOCK = "/sys/block"
+SECTOR_SIZE = 512  # sysfs sizes are always in 512 bytes sectors
+
+_buffers = threading.local()
+
+
+def get_buffer(size):
+    """page-aligned buffer of size bytes, one per thread (reused)"""
+    size = max(PAGE_SIZE, size - size % PAGE_SIZE)
+    buf = getattr(_buffers, "buf", None)
+    if buf is None or len(buf) != size:
+        # anonymous mmap is page aligned
+        buf = memoryview(mmap.mmap(-1, size))
+        _buffers.buf = buf
+    return buf
+
+
+def create_folders(dst, fnames):
+    """create all parent folders of fnames (relative paths) in dst at once"""
+    folders = set([os.path.dirname(fname) for fname in fnames]) - set([""])
+    for folder in sorted(folders):
+        os.makedirs(os.path.join(dst, folder), exist_ok=True)
+    return len(folders)
+
+
+def get_hasher():
+    return hashlib.new(settings.USB_HASH_ALGORITHM)
+
+
+def copy_file(src_fpath, dst_fpath, buffer_size=None):
+    """copy a file's content and times (no flush)
+
+    content is hashed while streamed. Returns nb of bytes and checksum"""
+    buf = get_buffer(buffer_size or settings.USB_COPY_BUFFER_SIZE)
+    hasher = get_hasher()
+    nb_bytes = 0
+    with open(src_fpath, "rb", buffering=0) as src, open(
+        dst_fpath, "wb", buffering=0
+    ) as dst:
+        while True:
+            nb_read = src.readinto(buf)
+            if not nb_read:
+                break
+            view = buf[:nb_read]
+            hasher.update(view)
+            while view:
+                view = view[dst.write(view) :]
+            nb_bytes += nb_read
+
+    # FAT has no permissions: only keep times
+    stat = os.stat(src_fpath)
+    try:
+        os.utime(dst_fpath, (stat.st_atime, stat.st_mtime))
+    except OSError:
+        pass
+    return nb_bytes, hasher.hexdigest()
+
+
+def copy_files(src, dst, fnames, workers=None, on_copied=None, sync=True):
+    """copy fnames (paths relative to src) to dst using a pool of writers
+
+    folders are created upfront and data is synced to disk only once, at
+    the end (unless sync is False). on_copied(fname, nb_bytes, error) is
+    called from the writer threads after each file. Returns copy stats
+    including errors and checksums of copied files."""
+    if workers is None:
+        workers = settings.USB_COPY_WORKERS
+
+    started = time.monotonic()
+    create_folders(dst, fnames)
+
+    def do_copy(fname):
+        try:
+            nb_bytes, checksum = copy_file(
+                os.path.join(src, fname), os.path.join(dst, fname)
+            )
+        except Exception as exp:
+            logger.error("Failed to copy {}".format(fname))
+            logger.exception(exp)
+            nb_bytes, checksum, error = 0, None, exp
+        else:
+            error = None
+        if on_copied is not None:
+            on_copied(fname, nb_bytes, error)
+        return fname, nb_bytes, checksum, error
+
+    with ThreadPoolExecutor(max_workers=max(workers, 1)) as executor:
+        results = list(executor.map(do_copy, fnames))
+
+    # a single flush of all written data (page cache) to the stick
+    sync_started = time.monotonic()
+    if sync:
+        os.sync()
+    sync_duration = time.monotonic() - sync_started
+
+    duration = time.monotonic() - started
+    nb_bytes = sum([nb for _, nb, _, _ in results])
+    stats = {
+        "files": len(results),
+        "bytes": nb_bytes,
+        "errors": [(fname, error) for fname, _, _, error in results if error],
+        "hashes": {fname: checksum for fname, _, checksum, err in results if not err},
+        "duration": duration,
+        "sync_duration": sync_duration,
+        "throughput": nb_bytes / duration if duration else 0,
+    }
+    logger.info(
+        "Copied {files} files ({size}) in {d:.1f}s "
+        "(sync {sd:.1f}s): {speed}/s".format(
+            files=stats["files"],
+            size=humanfriendly.format_size(nb_bytes),
+            d=duration,
+            sd=sync_duration,
+            speed=humanfriendly.format_size(stats["throughput"]),
+        )
+    )
+    return stats
+
+
+def get_archive_fname(prefix, index):
+    return "{prefix}-{index:03d}.zip".format(prefix=prefix, index=index)
+
+
+def pack_files(
+    src,
+    dst,
+    files_sizes,
+    prefix,
+    compression=None,
+    max_size=None,
+    on_copied=None,
+):
+    """stream files (relative to src) into zip archives written to dst
+
+    archives are written one after the other and a new one is started
+    before going over max_size. Returns the list of archives, the archive
+    and checksum of each file and the files that failed."""
+    compression = compression or settings.USB_ARCHIVE_COMPRESSION
+    max_size = max_size or settings.USB_ARCHIVE_MAX_SIZE
+    buf = get_buffer(settings.USB_COPY_BUFFER_SIZE)
+
+    archives = []
+    files = []
+    errors = []
+    archive = None
+    archive_size = 0
+    try:
+        for fname, size in files_sizes:
+            if archive is None or (archive_size and archive_size + size > max_size):
+                if archive is not None:
+                    archive.close()
+                archives.append(
+                    {"name": get_archive_fname(prefix, len(archives) + 1), "files": 0}
+                )
+                archive = zipfile.ZipFile(
+                    os.path.join(dst, archives[-1]["name"]),
+                    "w",
+                    compression=COMPRESSIONS[compression],
+                    allowZip64=True,
+                )
+                archive_size = 0
+
+            fpath = os.path.join(src, fname)
+            hasher = get_hasher()
+            try:
+                zinfo = zipfile.ZipInfo.from_file(fpath, fname)
+                zinfo.compress_type = COMPRESSIONS[compression]
+                with open(fpath, "rb", buffering=0) as fsrc, archive.open(
+                    zinfo, "w", force_zip64=size > zipfile.ZIP64_LIMIT
+                ) as fdst:
+                    while True:
+                        nb_read = fsrc.readinto(buf)
+                        if not nb_read:
+                            break
+                        hasher.update(buf[:nb_read])
+                        fdst.write(buf[:nb_read])
+            except Exception as exp:
+                logger.error("Failed to pack {}".format(fname))
+                logger.exception(exp)
+                error = exp
+                errors.append((fname, exp))
+            else:
+                error = None
+                archive_size += size
+                archives[-1]["files"] += 1
+                files.append(
+                    {
+                        "path": fname,
+                        "size": size,
+                        "hash": hasher.hexdigest(),
+                        "archive": archives[-1],
+                    }
+                )
+            if on_copied is not None:
+                on_copied(fname, size, error)
+    finally:
+        if archive is not None:
+            archive.close()
+
+    for entry in archives:
+        entry["size"] = os.path.getsize(os.path.join(dst, entry["name"]))
+    for entry in files:
+        entry["archive"] = entry["archive"]["name"]
+    return archives, files, errors
+
+
+def write_manifest(dst, manifest):
+    with open(os.path.join(dst, MANIFEST_FNAME), "w", encoding="UTF-8") as f:
+        json.dump(manifest, f, indent=4)
+
+
+def export_collect_tree(
+    src, dst, files_sizes, mode=FILES_MODE, compression=None, on_copied=None
+):
+    """copy collect's documents folder to dst, packing large trees in ARCHIVE_MODE
+
+    a manifest of the exported files (with checksums) is written at the
+    root of dst. Returns stats as in copy_files, with the manifest."""
+    assert mode in MODES
+    started = time.monotonic()
+    compression = compression or settings.USB_ARCHIVE_COMPRESSION
+
+    def archived_folder(fname):
+        if mode != ARCHIVE_MODE:
+            return None
+        folder = fname.split(os.sep, 1)[0]
+        return folder if folder in ARCHIVED_FOLDERS and folder != fname else None
+
+    to_copy = [(f, size) for f, size in files_sizes if archived_folder(f) is None]
+    stats = copy_files(
+        src, dst, [f for f, _ in to_copy], on_copied=on_copied, sync=False
+    )
+    manifest = {
+        "mode": mode,
+        "hash": settings.USB_HASH_ALGORITHM,
+        "files": [
+            {"path": f, "size": size, "hash": stats["hashes"].get(f)}
+            for f, size in to_copy
+        ],
+        "archives": [],
+    }
+    if mode == ARCHIVE_MODE:
+        manifest["compression"] = compression
+        for folder in ARCHIVED_FOLDERS:
+            archives, files, errors = pack_files(
+                src,
+                dst,
+                [(f, size) for f, size in files_sizes if archived_folder(f) == folder],
+                prefix=folder,
+                compression=compression,
+                on_copied=on_copied,
+            )
+            manifest["archives"] += archives
+            manifest["files"] += files
+            stats["errors"] += errors
+
+    # files that failed are not listed
+    failed = set([fname for fname, _ in stats["errors"]])
+    manifest["files"] = [f for f in manifest["files"] if f["path"] not in failed]
+    write_manifest(dst, manifest)
+
+    sync_started = time.monotonic()
+    os.sync()
+    stats["sync_duration"] = time.monotonic() - sync_started
+
+    stats["files"] = len(files_sizes)
+    stats["bytes"] = sum([size for _, size in files_sizes])
+    stats["archives"] = len(manifest["archives"])
+    stats["manifest"] = manifest
+    stats["duration"] = time.monotonic() - started
+    stats["throughput"] = stats["bytes"] / stats["duration"] if stats["duration"] else 0
+    return stats
+
+
+def drop_cached_pages(fpath):
+    """evict fpath's (synced) pages from page cache so next reads hit the disk"""
+    if not hasattr(os, "posix_fadvise"):
+        return
+    fd = os.open(fpath, os.O_RDONLY)
+    try:
+        os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+    finally:
+        os.close(fd)
+
+
+def read_checksum(fobj, buf):
+    hasher = get_hasher()
+    while True:
+        nb_read = fobj.readinto(buf)
+        if not nb_read:
+            break
+        hasher.update(buf[:nb_read])
+    return hasher.hexdigest()
+
+
+def verify_export(dst, manifest, sample_ratio=None, on_verified=None):
+    """re-read files from the stick and compare their checksums to manifest's
+
+    files which size on the stick differs are always verified, others are
+    sampled. Must be called once data is synced. on_verified(fname, error)
+    is called after each verified file. Returns verify stats with errors."""
+    if sample_ratio is None:
+        sample_ratio = settings.USB_VERIFY_SAMPLE_RATIO
+
+    started = time.monotonic()
+    buf = get_buffer(settings.USB_COPY_BUFFER_SIZE)
+    entries = [entry for entry in manifest["files"] if entry.get("hash")]
+
+    archives = {}
+    for name in set([entry.get("archive") for entry in entries]) - set([None]):
+        fpath = os.path.join(dst, name)
+        try:
+            drop_cached_pages(fpath)
+            archives[name] = zipfile.ZipFile(fpath)
+        except Exception as exp:
+            archives[name] = exp
+
+    def get_size(entry):
+        if entry.get("archive"):
+            return archives[entry["archive"]].getinfo(entry["path"]).file_size
+        return os.path.getsize(os.path.join(dst, entry["path"]))
+
+    suspects = []
+    others = []
+    for entry in entries:
+        try:
+            size = get_size(entry)
+        except Exception:
+            size = None
+        if size != entry["size"]:
+            suspects.append(entry)
+        else:
+            others.append(entry)
+    nb_sampled = min(len(others), int(math.ceil(len(others) * sample_ratio)))
+    to_verify = suspects + random.sample(others, nb_sampled)
+
+    errors = []
+    try:
+        for entry in to_verify:
+            try:
+                if entry.get("archive"):
+                    archive = archives[entry["archive"]]
+                    if isinstance(archive, Exception):
+                        raise archive
+                    fobj = archive.open(entry["path"])
+                else:
+                    fpath = os.path.join(dst, entry["path"])
+                    drop_cached_pages(fpath)
+                    fobj = open(fpath, "rb", buffering=0)
+                with fobj:
+                    checksum = read_checksum(fobj, buf)
+                if checksum != entry["hash"]:
+                    raise ValueError("contenu corrompu (somme de contrôle)")
+            except Exception as exp:
+                logger.error("Failed to verify {}: {}".format(entry["path"], exp))
+                error = exp
+                errors.append((entry["path"], exp))
+            else:
+                error = None
+            if on_verified is not None:
+                on_verified(entry["path"], error)
+    finally:
+        for archive in archives.values():
+            if not isinstance(archive, Exception):
+                archive.close()
+
+    stats = {
+        "files": len(to_verify),
+        "suspects": len(suspects),
+        "errors": errors,
+        "duration": time.monotonic() - started,
+    }
+    logger.info(
+        "Verified {files} files ({suspects} suspects) in {d:.1f}s: "
+        "{nb} error(s)".format(d=stats["duration"], nb=len(errors), **stats)
+    )
+    return stats
+
+
+def read_sysfs(dev_name, attr, default=None):
+    try:
+        with open(os.path.join(SYSFS_BLOCK, dev_name, attr), "r") as f:
+            return f.read().strip()
+    except OSError:
+        return default
+
+
+def get_disk_info(device_path):
+    """size and model of a block device (/dev/sdX) read from sysfs"""
+    dev_name = os.path.basename(device_path)
+    model = " ".join(
+        [
+            part
+            for part in (
+                read_sysfs(dev_name, "device/vendor"),
+                read_sysfs(dev_name, "device/model"),
+            )
+            if part
+        ]
+    )
+    return {
+        "path": device_path,
+        "name": model or dev_name,
+        "size": int(read_sysfs(dev_name, "size", 0)) * SECTOR_SIZE,
+        "removable": read_sysfs(dev_name, "removable") == "1",
+    }
+
+
+def scan_usb_disks():
+    """info of all USB whole disks (no partitions) plugged"""
+    if not sys.platform.startswith("linux"):
+        if settings.DEBUG:
+            return [
+                {
+                    "path": "/dev/sdd",
+                    "name": "Virtual USB",
+                    "size": 32000000000,
+                    "removable": True,
+                }
+            ]
+        else:
+            raise NotImplementedError("USB exports is Linux-only")
+
+    disks = set()
+    if os.path.isdir(DISKS_BY_PATH):
+        for fname in os.listdir(DISKS_BY_PATH):
+            # USB-only, whole disks only
+            if "usb" in fname and "part" not in fname:
+                path = os.path.join(DISKS_BY_PATH, fname)
+                disks.add(os.path.realpath(path))
+    return [get_disk_info(disk) for disk in sorted(disks)]
+
+
+class DiskInventory(object):
+    """cached list of plugged USB disks
+
+    udev updates DISKS_BY_PATH on each (un)plug so the list is only
+    rescanned when that folder changed (or the cache is older than
+    USB_DISKS_CACHE_TTL, as a safety net)."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.disks = None
+        self.key = None
+        self.scanned_on = 0
+
+    @staticmethod
+    def get_key():
+        try:
+            return os.stat(DISKS_BY_PATH).st_mtime_ns
+        except OSError:
+            return None
+
+    def is_stale(self, key):
+        return (
+            self.disks is None
+            or key != self.key
+            or time.monotonic() - self.scanned_on > settings.USB_DISKS_CACHE_TTL
+        )
+
+    def get_disks(self, refresh=False):
+        with self.lock:
+            key = self.get_key()
+            if refresh or self.is_stale(key):
+                self.disks = scan_usb_disks()
+                self.key = key
+                self.scanned_on = time.monotonic()
+                logger.debug("USB disks: {}".format(self.disks))
+            return list(self.disks)
+
+
+disk_inventory = DiskInventory()
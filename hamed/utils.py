@@ -9,24 +9,39 @@ import sys
 import lzma
 import json
 import string
+import hashlib
 import logging
+import time
 import tempfile
 import datetime
+import itertools
 import unicodedata
+import multiprocessing
+from multiprocessing.pool import MaybeEncodingError
+from functools import lru_cache
+from concurrent.futures import ThreadPoolExecutor
 
 import sh
 import requests
 import humanfriendly
 from path import Path as P
 from django.conf import settings
+from django.db import connections
 from django.db.models import QuerySet
 
+from hamed.exports.pdf import (
+    social_survey,
+    indigence_certificate,
+    residence_certificate,
+)
 from hamed.exports.pdf.social_survey import gen_social_survey_pdf
 from hamed.exports.pdf.indigence_certificate import gen_indigence_certificate_pdf
 from hamed.exports.pdf.residence_certificate import gen_residence_certificate_pdf
+from hamed.constants import PERSONAL_FILES, PRINTS
 from hamed.models.settings import Settings
 from hamed.ona import (
-    download_media,
+    get_url,
+    download_media_to,
     download_xlsx_export,
     download_json_export,
     XLSX_MIME,
@@ -34,15 +49,20 @@ from hamed.ona import (
     DATAENTRY_ROLE,
     READONLY_ROLE,
 )
-from hamed.exceptions import MultipleUSBDisksPlugged, NoUSBDiskPlugged
+from hamed.exceptions import (
+    MultipleUSBDisksPlugged,
+    NoUSBDiskPlugged,
+    DocumentsGenerationError,
+    MediasExportError,
+)
+from hamed.usb import disk_inventory
 
 logger = logging.getLogger(__name__)
 
-PERSONAL_FILES = "Dossiers"
-PRINTS = "Impressions"
 SURVEYS = "Enquetes"
 INDIGENCES = "Certificats indigence"
 RESIDENCES = "Certificats residence"
+DOCUMENTS_MANIFEST = ".manifest.json"
 MIMES = {
     "json": "application/json",
     "xlsx": XLSX_MIME,
@@ -97,7 +117,110 @@ def get_export_fname(kind, collect):
     return templates.get(kind).format(ona_id=collect.ona_form_id())
 
 
-def gen_targets_documents(targets):
+@lru_cache(maxsize=1)
+def get_documents_template_version():
+    """digest of the PDF generators sources and DOCUMENTS_TEMPLATE_VERSION"""
+    digest = hashlib.sha1(str(settings.DOCUMENTS_TEMPLATE_VERSION).encode("UTF-8"))
+    for module in (social_survey, indigence_certificate, residence_certificate):
+        with open(module.__file__, "rb") as f:
+            digest.update(f.read())
+    return digest.hexdigest()
+
+
+def get_target_documents_hash(target):
+    """digest of everything the documents of target are rendered from"""
+    payload = {
+        "identifier": target.identifier,
+        "dataset": target.dataset,
+        "mayor": target.collect.mayor,
+        "commune": target.collect.commune,
+        "cercle": target.collect.cercle,
+        "template": get_documents_template_version(),
+    }
+    return hashlib.sha1(
+        json.dumps(payload, sort_keys=True, default=str).encode("UTF-8")
+    ).hexdigest()
+
+
+def get_target_documents_fpaths(target):
+    """paths of the documents generated for target"""
+    prints_folder = os.path.join(target.collect.get_documents_path(), PRINTS)
+    return [
+        os.path.join(target.get_folder_path(), get_document_fname("survey", target))
+    ] + [
+        os.path.join(prints_folder, subfolder, get_document_fname(kind, target))
+        for kind, subfolder in (
+            ("indigence", INDIGENCES),
+            ("residence", RESIDENCES),
+            ("survey", SURVEYS),
+        )
+    ]
+
+
+def get_documents_manifest_path(collect):
+    return os.path.join(collect.get_documents_path(), DOCUMENTS_MANIFEST)
+
+
+def load_documents_manifest(collect):
+    """{identifier: {submission, hash, files}} of documents on disk"""
+    try:
+        with open(get_documents_manifest_path(collect), "r") as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+    except ValueError as exp:
+        logger.warning("Ignoring corrupted documents manifest: {}".format(exp))
+        return {}
+
+
+def save_documents_manifest(collect, manifest):
+    fpath = get_documents_manifest_path(collect)
+    if not manifest:
+        P(fpath).remove_p()
+        return
+    P(collect.get_documents_path()).makedirs_p()
+    with open("{}.tmp".format(fpath), "w") as f:
+        json.dump(manifest, f)
+    os.replace("{}.tmp".format(fpath), fpath)
+
+
+def get_manifest_entry(target):
+    croot = target.collect.get_documents_path()
+    return {
+        "submission": target.dataset.get("_id"),
+        "hash": get_target_documents_hash(target),
+        "files": [
+            os.path.relpath(fpath, croot)
+            for fpath in get_target_documents_fpaths(target)
+        ],
+    }
+
+
+def is_manifest_entry_current(collect, entry, expected):
+    """whether documents listed in entry are still those expected, on disk"""
+    return (
+        entry is not None
+        and entry.get("hash") == expected["hash"]
+        and entry.get("files") == expected["files"]
+        and all(
+            [
+                os.path.exists(os.path.join(collect.get_documents_path(), fname))
+                for fname in entry["files"]
+            ]
+        )
+    )
+
+
+def gen_targets_documents(targets, workers=None, force=False):
+    """generate the 3 PDF documents of each target
+
+    targets which documents are already rendered from the same inputs
+    (see the collect's documents manifest) are skipped unless forced.
+    Others are dispatched by chunks to a pool of worker processes
+    (settings.DOCUMENTS_WORKERS) and rendered serially if that's not
+    possible. Failures are gathered and raised at the end, in order.
+
+    Returns numbers of targets rendered and skipped."""
     from hamed.models.collects import Collect
 
     # ensure we have destinations folder
@@ -116,36 +239,149 @@ def gen_targets_documents(targets):
         for prints_subfolder in (SURVEYS, INDIGENCES, RESIDENCES):
             P(os.path.join(prints_folder, prints_subfolder)).makedirs_p()
 
-        survey_links_folder = os.path.join(prints_folder, SURVEYS)
-        P(survey_links_folder).makedirs_p()
-
+    # only render documents which inputs changed since last rendering
+    manifests = {collect.pk: load_documents_manifest(collect) for collect in collects}
+    entries = {}
     for target in targets:
+        entry = get_manifest_entry(target)
+        current = manifests[target.collect_id].get(target.identifier)
+        if force or not is_manifest_entry_current(target.collect, current, entry):
+            entries[target.identifier] = entry
+    nb_skipped = len(targets) - len(entries)
+    logger.info(
+        "Documents: {nb} to render, {skipped} up to date".format(
+            nb=len(entries), skipped=nb_skipped
+        )
+    )
+    targets = [target for target in targets if target.identifier in entries]
 
-        # social survey
-        P(target.get_folder_path()).makedirs_p()  # ensure personnal folder OK
-        if not os.path.exists(target.get_folder_path()):
-            os.sync()
-        survey = gen_social_survey_pdf(target)
-        survey_fname = get_document_fname("survey", target)
-        survey_fpath = os.path.join(target.get_folder_path(), survey_fname)
-        with open(survey_fpath, "wb") as f:
-            f.write(survey.read())
+    if workers is None:
+        workers = settings.DOCUMENTS_WORKERS or os.cpu_count() or 1
 
-        # indigence certificate and residence certificate goes to print folder
-        for kind, subfolder, gen_func in (
-            ("indigence", INDIGENCES, gen_indigence_certificate_pdf),
-            ("residence", RESIDENCES, gen_residence_certificate_pdf),
-        ):
-            document = gen_func(target)
-            document_fpath = os.path.join(
-                prints_folder, subfolder, get_document_fname(kind, target)
+    results = None
+    if workers > 1 and len(targets) > settings.DOCUMENTS_CHUNK_SIZE:
+        try:
+            results = gen_documents_in_pool(
+                [t.identifier for t in targets], workers=workers
             )
-            with open(document_fpath, "wb") as f:
-                f.write(document.read())
+        except (OSError, multiprocessing.ProcessError, MaybeEncodingError) as exp:
+            logger.error("Documents pool failed, falling back to serial mode.")
+            logger.exception(exp)
 
-        # survey is also copied (not synlinked --printer issue--) in prints
-        survey_link_fpath = os.path.join(survey_links_folder, survey_fname)
-        P(survey_fpath).copy2(survey_link_fpath)
+    if results is None:
+        results = [do_gen_target_documents(target) for target in targets]
+
+    # record what's been rendered, even if some failed
+    targets_collects = {target.identifier: target.collect_id for target in targets}
+    for ident, error in results:
+        if not error:
+            manifests[targets_collects[ident]][ident] = entries[ident]
+    for collect in collects:
+        save_documents_manifest(collect, manifests[collect.pk])
+
+    errors = [(ident, error) for ident, error in results if error]
+    if errors:
+        raise DocumentsGenerationError(errors)
+
+    return {"rendered": len(results), "skipped": nb_skipped}
+
+
+def remove_orphan_documents(collect):
+    """remove documents of identifiers in manifest which are not targets anymore
+
+    documents are kept when targets are reset (reopening a collect) so
+    that submissions imported again reuse them."""
+    manifest = load_documents_manifest(collect)
+    identifiers = set(collect.targets.values_list("identifier", flat=True))
+    orphans = [ident for ident in manifest.keys() if ident not in identifiers]
+    for ident in orphans:
+        fpaths = [
+            os.path.join(collect.get_documents_path(), fname)
+            for fname in manifest.pop(ident)["files"]
+        ]
+        for fpath in fpaths:
+            P(fpath).remove_p()
+        # first document is in the personnal folder, along with the QR code
+        from hamed.models.targets import QRCODE_FNAME
+
+        folder = P(fpaths[0]).parent
+        P(os.path.join(folder, QRCODE_FNAME)).remove_p()
+        folder.removedirs_p()
+    if orphans:
+        logger.info("Removed documents of {} orphan(s)".format(len(orphans)))
+        save_documents_manifest(collect, manifest)
+
+
+def gen_documents_in_pool(identifiers, workers):
+    """[(identifier, error)] in order, chunks rendered by forked workers"""
+    # forked workers must not share parent's database connection
+    connections.close_all()
+    identifiers_chunks = list(chunks(identifiers, settings.DOCUMENTS_CHUNK_SIZE))
+    # (ProcessPoolExecutor only accepts a context from python 3.7)
+    with multiprocessing.get_context("fork").Pool(
+        processes=min(workers, len(identifiers_chunks))
+    ) as pool:
+        return [
+            result
+            for chunk_results in pool.map(gen_identifiers_documents, identifiers_chunks)
+            for result in chunk_results
+        ]
+
+
+def gen_identifiers_documents(identifiers):
+    """worker entry point: render documents for those target identifiers"""
+    from hamed.models.targets import Target
+
+    results = []
+    for identifier in identifiers:
+        target = Target.get_or_none(identifier)
+        if target is None:
+            results.append((identifier, "No such target"))
+        else:
+            results.append(do_gen_target_documents(target))
+    return results
+
+
+def do_gen_target_documents(target):
+    """(identifier, error message or None) after rendering target's documents"""
+    try:
+        gen_target_documents(target)
+    except Exception as exp:
+        logger.error("Failed to generate documents for {}".format(target))
+        logger.exception(exp)
+        return (target.identifier, str(exp))
+    return (target.identifier, None)
+
+
+def gen_target_documents(target):
+    prints_folder = os.path.join(target.collect.get_documents_path(), PRINTS)
+    survey_links_folder = os.path.join(prints_folder, SURVEYS)
+
+    # social survey
+    P(target.get_folder_path()).makedirs_p()  # ensure personnal folder OK
+    if not os.path.exists(target.get_folder_path()):
+        os.sync()
+    survey = gen_social_survey_pdf(target)
+    survey_fname = get_document_fname("survey", target)
+    survey_fpath = os.path.join(target.get_folder_path(), survey_fname)
+    with open(survey_fpath, "wb") as f:
+        f.write(survey.read())
+
+    # indigence certificate and residence certificate goes to print folder
+    for kind, subfolder, gen_func in (
+        ("indigence", INDIGENCES, gen_indigence_certificate_pdf),
+        ("residence", RESIDENCES, gen_residence_certificate_pdf),
+    ):
+        document = gen_func(target)
+        document_fpath = os.path.join(
+            prints_folder, subfolder, get_document_fname(kind, target)
+        )
+        with open(document_fpath, "wb") as f:
+            f.write(document.read())
+
+    # survey is also copied (not synlinked --printer issue--) in prints
+    survey_link_fpath = os.path.join(survey_links_folder, survey_fname)
+    P(survey_fpath).copy2(survey_link_fpath)
 
 
 def remove_targets_documents(targets):
@@ -164,6 +400,7 @@ def remove_targets_documents(targets):
         survey_fname = get_document_fname("survey", target)
         survey_fpath = os.path.join(target.get_folder_path(), survey_fname)
         P(survey_fpath).remove_p()
+        P(target.get_qrcode_path()).remove_p()
 
         # prints folder contains certificates and a copy of survey
         prints_folder = os.path.join(target.collect.get_documents_path(), PRINTS)
@@ -179,7 +416,17 @@ def remove_targets_documents(targets):
         # attempt to remove empty personnal folder
         P(target.get_folder_path()).removedirs_p()
 
+    identifiers = set([target.identifier for target in targets])
     for collect in collects:
+        manifest = load_documents_manifest(collect)
+        save_documents_manifest(
+            collect,
+            {
+                ident: entry
+                for ident, entry in manifest.items()
+                if ident not in identifiers
+            },
+        )
         cleanup_empty_folders(collect)
 
 
@@ -209,27 +456,79 @@ def export_collect_medias(collect):
     # ensure folder is ready
     check_targets_documents_folder(collect)
 
-    for target in collect.targets.all():
-        export_target_medias(target)
+    return export_targets_medias(collect.targets.all())
 
 
 def export_target_medias(target):
-    # ensure personnal folder OK
-    P(target.get_folder_path()).makedirs_p()
+    return export_targets_medias([target])
 
-    def export_media(attachment):
-        try:
-            output_fpath = os.path.join(
-                target.get_folder_path(), attachment["export_fname"]
+
+def export_targets_medias(targets, workers=None):
+    """download all targets' medias to their folders, concurrently
+
+    medias already on disk with the expected size are skipped and
+    partial downloads are resumed. Returns throughput stats."""
+    if workers is None:
+        workers = settings.MEDIAS_EXPORT_WORKERS
+
+    # URLs are resolved upfront so that worker threads don't hit the DB
+    jobs = []
+    for target in targets:
+        # ensure personnal folder OK
+        P(target.get_folder_path()).makedirs_p()
+        for attachment in target.list_attachments():
+            jobs.append(
+                (
+                    get_url(attachment["download_url"]),
+                    os.path.join(target.get_folder_path(), attachment["export_fname"]),
+                    attachment.get("filesize"),
+                )
             )
-            with open(output_fpath, "wb") as f:
-                f.write(download_media(attachment["download_url"]).read())
-        except Exception as exp:
-            logger.exception(exp)
-            raise
 
-    for attachment in target.list_attachments():
-        export_media(attachment)
+    started = time.monotonic()
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+        results = list(executor.map(lambda job: export_media(*job), jobs))
+    duration = time.monotonic() - started
+
+    nb_bytes = sum([nb or 0 for _, nb, _ in results])
+    stats = {
+        "files": len(results),
+        "skipped": len([1 for _, nb, _ in results if nb is None]),
+        "bytes": nb_bytes,
+        "duration": duration,
+        "throughput": nb_bytes / duration if duration else 0,
+    }
+    logger.info(
+        "Exported {files} medias ({skipped} skipped): {size} in {d:.1f}s "
+        "({speed}/s)".format(
+            files=stats["files"],
+            skipped=stats["skipped"],
+            size=humanfriendly.format_size(nb_bytes),
+            d=duration,
+            speed=humanfriendly.format_size(stats["throughput"]),
+        )
+    )
+
+    errors = [(fpath, error) for fpath, _, error in results if error]
+    if errors:
+        raise MediasExportError(errors)
+    return stats
+
+
+def export_media(url, output_fpath, expected_size=None):
+    """(fpath, bytes downloaded or None if skipped, error message or None)"""
+    if (
+        expected_size is not None
+        and os.path.exists(output_fpath)
+        and os.path.getsize(output_fpath) == expected_size
+    ):
+        return (output_fpath, None, None)
+    try:
+        nb_bytes = download_media_to(url, output_fpath, expected_size)
+    except Exception as exp:
+        logger.exception(exp)
+        return (output_fpath, 0, str(exp))
+    return (output_fpath, nb_bytes, None)
 
 
 def remove_collect_medias(collect):
@@ -343,12 +642,21 @@ def do_upload_export_data(server_url, token, data, compressed=True):
 
 
 def list_files(folder):
+    return [fname for fname, _ in list_files_sizes(folder)]
+
+
+def list_files_sizes(folder, root=None):
+    """[(path relative to folder, size)] of non-hidden files, recursively"""
+    root = folder if root is None else root
     all_files = []
-    for root, folders, filenames in os.walk(folder):
-        for filename in filter(lambda x: not x.startswith("."), filenames):
-            full_path = os.path.join(root, filename)
-            rel_path = P(full_path).relpath(folder)
-            all_files.append(rel_path)
+    with os.scandir(folder) as entries:
+        for entry in entries:
+            if entry.is_dir(follow_symlinks=False):
+                all_files += list_files_sizes(entry.path, root)
+            elif entry.is_file() and not entry.name.startswith("."):
+                all_files.append(
+                    (os.path.relpath(entry.path, root), entry.stat().st_size)
+                )
     return all_files
 
 
@@ -360,50 +668,16 @@ def get_us_env():
     return env
 
 
-def parse_parted_info(device_path):
-    if not sys.platform.startswith("linux"):
-        if settings.DEBUG:
-            return ("/dev/sdd", "32.0GB", 32000000000, "msdos", "Virtual USB")
-        else:
-            raise NotImplemented("USB exports is Linux-only")
-
-    pcmd = sh.sudo.parted("-s", "-m", device_path, "print", _env=get_us_env())
-    assert pcmd.exit_code == 0
-    line = str(pcmd).splitlines()[1]
-    path, size, driver, sector, block, mbr, name, _ = line.split(":")
-    sizeInBytes = humanfriendly.parse_size(size)
-    return (path, size, sizeInBytes, mbr, name)
-
-
-def find_export_disk():
-    if not sys.platform.startswith("linux"):
-        if settings.DEBUG:
-            return "/dev/sdd"
-        else:
-            raise NotImplemented("USB exports is Linux-only")
-
+def get_export_disk(refresh=False):
+    """info of the sole USB disk (<40GB) plugged, from the disk inventory"""
     max_size = 40 * 1e9
 
-    # list devices (usb only)
-    disks = []
-    basedir = "/dev/disk/by-path/"
-    if P(basedir).exists():
-        for fname in os.listdir(basedir):
-            # USB-only, whole disks only
-            if "usb" in fname and "part" not in fname:
-                path = os.path.join(basedir, fname)
-                link = os.readlink(path)
-                disks.append(
-                    os.path.normpath(os.path.join(os.path.dirname(path), link))
-                )
-
-    # check size and exclude anything > 40GB
-    for disk in set(disks):
-        # device = parted.getDevice(disk)
-        device_info = parse_parted_info(disk)
-        sizeInBytes = device_info[2]
-        if sizeInBytes > max_size:
-            disks.remove(disk)
+    # exclude anything > 40GB and empty slots (card readers) of size 0
+    disks = [
+        disk
+        for disk in disk_inventory.get_disks(refresh=refresh)
+        if 0 < disk["size"] <= max_size
+    ]
 
     # assert only one remaining
     try:
@@ -420,6 +694,10 @@ def find_export_disk():
     return disks[0]
 
 
+def find_export_disk(refresh=False):
+    return get_export_disk(refresh=refresh)["path"]
+
+
 def unmount_device(device_path):
     if not sys.platform.startswith("linux"):
         if settings.DEBUG:
@@ -516,6 +794,16 @@ def activate_advanced_mode(date):
     settings.ADVANCED_MODE = (Settings.cercle_id(), date)
 
 
+def chunks(iterable, size):
+    """yield lists of at most `size` items from any iterable"""
+    iterator = iter(iterable)
+    while True:
+        chunk = list(itertools.islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
+
 def slugify_for_disk(text):
     valid_chars = "-_.() {l}{d}".format(l=string.ascii_letters, d=string.digits)
     slug = unicodedata.normalize("NFKD", text)
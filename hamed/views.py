@@ -6,9 +6,18 @@ import logging
 import re
 import os
 
+import requests
 import humanfriendly
-from django.http import Http404, HttpResponse, JsonResponse
+from django.http import (
+    Http404,
+    HttpResponse,
+    JsonResponse,
+    FileResponse,
+    StreamingHttpResponse,
+)
+from django.utils.http import http_date
 from django.shortcuts import render, redirect
+from django.urls import reverse
 from django.views.decorators.http import require_POST
 from django.contrib import messages
 from django import forms
@@ -18,40 +27,23 @@ import hamed_advanced
 from hamed.models.collects import Collect
 from hamed.models.targets import Target
 from hamed.models.settings import Settings
-from hamed.ona import get_form_detail, download_media
-from hamed.steps.start_collect import StartCollectTaskCollection
-from hamed.steps.end_collect import EndCollectTaskCollection
-from hamed.steps.finalize_collect import FinalizeCollectTaskCollection
-from hamed.steps.reopen_collect import ReopenCollectTaskCollection
-from hamed.locations import get_communes
+from hamed.models.jobs import Job
+from hamed.forms import NewCollectForm
+from hamed.ona import get_form_detail, get_url
+from hamed.media_cache import get_media_cache
 from hamed.utils import (
     get_export_fname,
     MIMES,
     upload_export_data,
-    find_export_disk,
-    parse_parted_info,
+    get_export_disk,
     is_advanced_mode,
     activate_advanced_mode,
 )
-from hamed.exceptions import MultipleUSBDisksPlugged, NoUSBDiskPlugged
+from hamed.exceptions import MultipleUSBDisksPlugged, NoUSBDiskPlugged, ONAAPIError
 
 logger = logging.getLogger(__name__)
 
 
-class NewCollectForm(forms.ModelForm):
-    class Meta:
-        model = Collect
-        fields = ["commune_id", "suffix", "mayor_title", "mayor_name"]
-
-    def __init__(self, *args, **kwargs):
-        super(NewCollectForm, self).__init__(*args, **kwargs)
-
-        cercle_id = Settings.cercle_id()
-        self.fields["commune_id"] = forms.ChoiceField(
-            label="Commune", choices=get_communes(cercle_id)
-        )
-
-
 def home(request):
     context = {
         "collects": {
@@ -68,7 +60,24 @@ def collect(request, collect_id):
     if collect is None:
         raise Http404("Aucune collecte avec l'ID `{}`".format(collect_id))
 
-    context = {"collect": collect, "advanced_mode": is_advanced_mode()}
+    context = {
+        "collect": collect,
+        "advanced_mode": is_advanced_mode(),
+        # background syncs don't block the page
+        "job": collect.jobs.filter(status__in=Job.UNFINISHED_STATUSES)
+        .exclude(kind=Job.SYNC)
+        .first(),
+    }
+
+    # suspended operation, resumed by running it again
+    context.update({"checkpoint": collect.checkpoints.first()})
+
+    # tasks metrics of the last operation
+    last_job = (
+        collect.jobs.filter(task_runs__isnull=False).exclude(kind=Job.SYNC).first()
+    )
+    if last_job is not None:
+        context.update({"last_job": last_job, "task_runs": last_job.task_runs.all()})
 
     ona_form = {}
     ona_scan_form = {}
@@ -95,11 +104,11 @@ def collect(request, collect_id):
 
     if collect.has_finalized():
         try:
-            disk = find_export_disk()
-            disk_info = parse_parted_info(disk)
+            disk_info = get_export_disk()
+            disk = disk_info["path"]
             disk_name = "{name} ({size})".format(
-                name=disk_info[4],
-                size=humanfriendly.format_size(disk_info[2], binary=True),
+                name=disk_info["name"],
+                size=humanfriendly.format_size(disk_info["size"], binary=True),
             )
         except NoUSBDiskPlugged:
             disk = None
@@ -186,136 +195,75 @@ def start_collect(request):
                 for error in field_errors:
                     errors.append("[{}] {}".format(form.fields[field].label, error))
         return fail(
-            "Informations incorrectes pour créér la collecte : {all}".format(
+            "Informations incorrectes pour créér la collecte : {all}".format(
                 all="\n".join(errors)
             )
         )
 
-    tc = StartCollectTaskCollection(form=form)
-    tc.process()
-    if tc.successful:
-        messages.success(
-            request,
-            "La collecte «{}» a bien été créée.".format(tc.inputs.get("collect")),
-        )
-        return redirect("collect", tc.inputs.get("collect").id)
-    elif not tc.clean_state:
-        return fail(
-            "Impossible de créer la collecte. "
-            "Erreur lors de la tentative "
-            "de retour à l'état précédent (exp: {})\n\n{}".format(
-                tc.exception, tc.traceback
-            )
-        )
-    else:
-        return fail(
-            "Impossible de créer la collecte. "
-            "Collecte retournée à l'état précédent. (exp: {})\n\n{}".format(
-                tc.exception, tc.traceback
-            )
-        )
-
+    # form is validated again by the worker, from the same data
+    job = Job.enqueue(
+        Job.START, payload={field: request.POST.get(field) for field in form.fields}
+    )
+    return redirect("job", job.id)
 
-@require_POST
-def end_collect(request, collect_id):
 
+def enqueue_collect_job(request, collect_id, kind):
+    """JSON response for a collect Job (the unfinished one if any)"""
     collect = Collect.get_or_none(collect_id)
     if collect is None:
         raise Http404("Aucune collecte avec l'ID `{}`".format(collect_id))
 
-    def fail(message):
-        messages.error(request, message)
-        return JsonResponse({"status": "error", "message": message})
+    job = Job.enqueue(kind, collect=collect)
+    return JsonResponse(
+        {
+            "status": "queued",
+            "job": job.to_dict(),
+            "status_url": reverse("job_status", kwargs={"job_id": job.id}),
+        }
+    )
 
-    tc = EndCollectTaskCollection(collect=collect)
-    tc.process()
-    if tc.successful:
-        message = "Collecte «{}» terminée.".format(collect)
-        messages.success(request, message)
-        return JsonResponse({"status": "success", "message": message})
-    elif not tc.clean_state:
-        return fail(
-            "Impossible de terminer la collecte. "
-            "Erreur lors de la tentative "
-            "de retour à l'état précédent. (exp: {})\n\n{}".format(
-                tc.exception, tc.traceback
-            )
-        )
-    else:
-        return fail(
-            "Impossible de terminer la collecte. "
-            "Collecte retournée à l'état précédent. (exp: {})\n\n{}".format(
-                tc.exception, tc.traceback
-            )
-        )
+
+@require_POST
+def end_collect(request, collect_id):
+    return enqueue_collect_job(request, collect_id, Job.END)
 
 
 @require_POST
 def finalize_collect(request, collect_id):
+    return enqueue_collect_job(request, collect_id, Job.FINALIZE)
 
-    collect = Collect.get_or_none(collect_id)
-    if collect is None:
-        raise Http404("Aucune collecte avec l'ID `{}`".format(collect_id))
 
-    def fail(message):
-        messages.error(request, message)
-        return JsonResponse({"status": "error", "message": message})
+@require_POST
+def reopen_collect(request, collect_id):
+    return enqueue_collect_job(request, collect_id, Job.REOPEN)
 
-    tc = FinalizeCollectTaskCollection(collect=collect)
-    tc.process()
-    if tc.successful:
-        message = "Collecte «{}» finalisée.".format(collect)
-        messages.success(request, message)
-        return JsonResponse({"status": "success", "message": message})
-    elif not tc.clean_state:
-        return fail(
-            "Impossible de finaliser la collecte. "
-            "Erreur lors de la tentative "
-            "de retour à l'état précédent (exp: {})\n\n{}".format(
-                tc.exception, tc.traceback
-            )
-        )
-    else:
-        return fail(
-            "Impossible de finaliser la collecte. "
-            "Collecte retournée à l'état précédent. (exp: {})\n\n{}".format(
-                tc.exception, tc.traceback
-            )
-        )
 
+def job(request, job_id):
+    job = Job.get_or_none(job_id)
+    if job is None:
+        raise Http404("Aucune opération avec l'ID `{}`".format(job_id))
 
-@require_POST
-def reopen_collect(request, collect_id):
+    context = {
+        "job": job,
+        "status_url": reverse("job_status", kwargs={"job_id": job.id}),
+    }
+    return render(request, "job.html", context)
 
-    collect = Collect.get_or_none(collect_id)
-    if collect is None:
-        raise Http404("Aucune collecte avec l'ID `{}`".format(collect_id))
 
-    def fail(message):
-        messages.error(request, message)
-        return JsonResponse({"status": "error", "message": message})
+def job_status(request, job_id):
+    """JSON state of a Job, polled by clients until it's finished"""
+    job = Job.get_or_none(job_id)
+    if job is None:
+        raise Http404("Aucune opération avec l'ID `{}`".format(job_id))
 
-    tc = ReopenCollectTaskCollection(collect=collect)
-    tc.process()
-    if tc.successful:
-        message = "Collecte «{}» ré-ouverte.".format(collect)
-        messages.success(request, message)
-        return JsonResponse({"status": "success", "message": message})
-    elif not tc.clean_state:
-        return fail(
-            "Impossible de ré-ouvrir la collecte. "
-            "Erreur lors de la tentative "
-            "de retour à l'état précédent (exp: {})\n\n{}".format(
-                tc.exception, tc.traceback
-            )
-        )
-    else:
-        return fail(
-            "Impossible de ré-ouvrir la collecte. "
-            "Collecte retournée à l'état précédent. (exp: {})\n\n{}".format(
-                tc.exception, tc.traceback
-            )
-        )
+    # outcome is displayed on the page client is redirected to
+    if job.finished and request.GET.get("notify"):
+        if job.status == Job.SUCCESS:
+            messages.success(request, job.message)
+        else:
+            messages.error(request, job.message)
+
+    return JsonResponse(job.to_dict())
 
 
 def attachment_proxy(request, fname):
@@ -348,10 +296,82 @@ def attachment_proxy(request, fname):
     if attachment is None:
         raise Http404("No attachment with name `{}`".format(fname))
 
-    return HttpResponse(
-        download_media(attachment.get("download_url")),
-        content_type=attachment.get("mimetype"),
+    try:
+        fd = get_media_cache().fetch(
+            get_url(attachment.get("download_url")),
+            key=attachment.get("filename"),
+            expected_size=attachment.get("filesize"),
+        )
+    except ONAAPIError as exp:
+        logger.error("Unable to download {}: {}".format(fname, exp))
+        if exp.http_code == 404:
+            raise Http404("Media `{}` not found on ONA".format(fname))
+        return HttpResponse("ONA error: {}".format(exp), status=502)
+    except requests.RequestException as exp:
+        logger.error("Unable to download {}: {}".format(fname, exp))
+        return HttpResponse("ONA unreachable: {}".format(exp), status=502)
+    return serve_file(request, fd, content_type=attachment.get("mimetype"))
+
+
+def serve_file(request, fd, content_type):
+    """stream an open file honoring conditional (ETag) and Range requests
+
+    fd is closed once served."""
+    stat = os.fstat(fd.fileno())
+    size = stat.st_size
+    etag = '"{mtime:x}-{size:x}"'.format(mtime=int(stat.st_mtime), size=size)
+    last_modified = http_date(stat.st_mtime)
+
+    def with_headers(response):
+        response["ETag"] = etag
+        response["Last-Modified"] = last_modified
+        response["Accept-Ranges"] = "bytes"
+        response["Cache-Control"] = "private, max-age=86400"
+        return response
+
+    if_none_match = request.META.get("HTTP_IF_NONE_MATCH")
+    if_modified_since = request.META.get("HTTP_IF_MODIFIED_SINCE")
+    if (if_none_match and etag in if_none_match) or (
+        not if_none_match and if_modified_since == last_modified
+    ):
+        fd.close()
+        return with_headers(HttpResponse(status=304))
+
+    range_match = re.match(
+        r"^bytes=(\d*)-(\d*)$", request.META.get("HTTP_RANGE", "").strip()
+    )
+    if range_match is None or range_match.groups() == ("", ""):
+        return with_headers(FileResponse(fd, content_type=content_type))
+
+    first, last = range_match.groups()
+    if first:
+        start, end = int(first), min(int(last), size - 1) if last else size - 1
+    else:
+        # suffix range: last N bytes
+        start, end = max(size - int(last), 0), size - 1
+    if start > end or start >= size:
+        fd.close()
+        response = HttpResponse(status=416)
+        response["Content-Range"] = "bytes */{}".format(size)
+        return with_headers(response)
+
+    def read_range(chunk_size=65536):
+        with fd:
+            fd.seek(start)
+            remaining = end - start + 1
+            while remaining > 0:
+                data = fd.read(min(chunk_size, remaining))
+                if not data:
+                    break
+                remaining -= len(data)
+                yield data
+
+    response = StreamingHttpResponse(
+        read_range(), status=206, content_type=content_type
     )
+    response["Content-Length"] = str(end - start + 1)
+    response["Content-Range"] = "bytes {}-{}/{}".format(start, end, size)
+    return with_headers(response)
 
 
 def exports_proxy(request, collect_id, format):